@@ -0,0 +1,106 @@
+'''
+Benchmark of the output compression codecs on our own output schema.
+
+Usage:
+    python -m PhysicsTools.NanoHRTTools.helpers.benchmarkCompression -i output.root \
+        -c LZ4:4,ZSTD:5,ZLIB:6,LZMA:9 --max-entries 100000 -o compression.json
+
+The `Events` tree of the input (a job output or a merged file) is rewritten w/ every codec (a slow `CloneTree`,
+i.e., all baskets are decompressed and compressed again), then read back entry by entry w/ all branches enabled.
+The write time includes reading the input, whose cost alone is reported as `input_read_seconds`.
+'''
+import os
+import json
+import time
+import socket
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+from .mergeHelper import compression_setting
+
+ROOT.gInterpreter.Declare('''
+Long64_t benchmarkCompressionReadAll(TTree *tree, Long64_t max_entries) {
+  Long64_t nbytes = 0;
+  Long64_t n = max_entries > 0 ? std::min(max_entries, tree->GetEntries()) : tree->GetEntries();
+  for (Long64_t i = 0; i < n; ++i) nbytes += tree->GetEntry(i);
+  return nbytes;
+}
+''')
+
+
+def read_tree(fname, max_entries=0, treename='Events'):
+    '''Returns (seconds, uncompressed bytes) to read the first `max_entries` (0: all) entries of `treename` in `fname`.'''
+    f = ROOT.TFile.Open(fname)
+    tree = f.Get(treename)
+    start = time.perf_counter()
+    nbytes = ROOT.benchmarkCompressionReadAll(tree, max_entries)
+    elapsed = time.perf_counter() - start
+    f.Close()
+    return elapsed, nbytes
+
+
+def write_tree(inputfile, outputfile, compression, max_entries, treename='Events'):
+    '''Returns (seconds, entries) to copy `treename` of `inputfile` into `outputfile` w/ `compression`.'''
+    fin = ROOT.TFile.Open(inputfile)
+    tree = fin.Get(treename)
+    fout = ROOT.TFile(outputfile, 'RECREATE', '', compression_setting(compression))
+    start = time.perf_counter()
+    out = tree.CloneTree(max_entries if max_entries else -1)
+    entries = out.GetEntries()
+    out.Write()
+    fout.Close()
+    elapsed = time.perf_counter() - start
+    fin.Close()
+    return elapsed, entries
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser('Benchmark write/read speed and size of the output compression codecs')
+    parser.add_argument('-i', '--input', required=True, help='Input file w/ the output schema (job or merged output).')
+    parser.add_argument('-c', '--codecs', default='LZ4:4,ZSTD:5,ZLIB:6,LZMA:9',
+                        help='Comma separated list of codecs, as `--compression`. Default: %(default)s')
+    parser.add_argument('--max-entries', type=int, default=100000,
+                        help='Max number of events to write, 0 for all. Default: %(default)s')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of reads of each file, the fastest is reported. Default: %(default)s')
+    parser.add_argument('--tmpdir', default=os.environ.get('TMPDIR', '/tmp'),
+                        help='Directory for the rewritten files. Default: %(default)s')
+    parser.add_argument('-o', '--output', default='compression.json', help='Output json file. Default: %(default)s')
+    args = parser.parse_args()
+
+    input_read = min(read_tree(args.input, args.max_entries)[0] for _ in range(args.repeat))
+    results = []
+    for codec in args.codecs.split(','):
+        fname = os.path.join(args.tmpdir, 'benchmarkCompression_%d_%s.root' % (os.getpid(), codec.replace(':', '_')))
+        try:
+            write_seconds, entries = write_tree(args.input, fname, codec, args.max_entries)
+            read_seconds, nbytes = min(read_tree(fname) for _ in range(args.repeat))
+            size = os.path.getsize(fname)
+        finally:
+            if os.path.exists(fname):
+                os.remove(fname)
+        res = {'codec': codec, 'entries': entries, 'size_mb': size / 1024. / 1024.,
+               'ratio': float(nbytes) / size if size else None,
+               'write_seconds': write_seconds, 'read_seconds': read_seconds,
+               'write_mb_per_sec': nbytes / 1024. / 1024. / write_seconds if write_seconds > 0 else None,
+               'read_mb_per_sec': nbytes / 1024. / 1024. / read_seconds if read_seconds > 0 else None,
+               'read_events_per_sec': entries / read_seconds if read_seconds > 0 else None}
+        results.append(res)
+        print('%-8s %8d events: %8.1f MB (ratio %.2f), write %.1f MB/s, read %.1f MB/s (%.0f events/s)' % (
+            codec, entries, res['size_mb'], res['ratio'] or 0, res['write_mb_per_sec'] or 0,
+            res['read_mb_per_sec'] or 0, res['read_events_per_sec'] or 0))
+
+    summary = {'input': os.path.abspath(args.input),
+               'input_read_seconds': input_read,
+               'root': ROOT.gROOT.GetVersion(),
+               'host': socket.getfqdn(),
+               'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'results': results}
+    with open(args.output, 'w') as fout:
+        json.dump(summary, fout, indent=2, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+'''
+Throughput benchmark of the on-the-fly ParticleNet tag-info production and inference.
+
+Usage:
+    python -m PhysicsTools.NanoHRTTools.helpers.benchmarkInference -i nano.root \
+        -m data/ParticleNet-MD/ak15/{version}/particle-net.onnx -p data/ParticleNet-MD/ak15/{version}/preprocess.json \
+        --version V02b --jet-branch AK15Puppi --jet-r 1.5 \
+        --batch-size 1,64,512 --threads 1,2,4 --fetch-step 100,1000 -o benchmark.json
+
+For every fetch window the stages run as in production (uproot read, feature conversion, preprocessing),
+followed by `sess.run` in batches and a lookup of every jet in the prediction cache. Wall and CPU times
+are reported per stage together with the jets/s. Each configuration runs in its own forked process, so
+its peak RSS is not inflated by the ones that ran before it.
+'''
+import os
+import json
+import time
+import socket
+import resource
+import multiprocessing
+import numpy as np
+import uproot
+import onnxruntime
+
+from .makeInputs import ParticleNetTagInfoMaker
+from .runPrediction import ParticleNetJetTagsProducer
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+
+    def time(self, stage, func, *args, **kwargs):
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        ret = func(*args, **kwargs)
+        self.wall[stage] = self.wall.get(stage, 0.) + time.perf_counter() - wall0
+        self.cpu[stage] = self.cpu.get(stage, 0.) + time.process_time() - cpu0
+        return ret
+
+    def summary(self, njets):
+        return {stage: {'wall': self.wall[stage], 'cpu': self.cpu[stage],
+                        'jets_per_sec': njets / self.wall[stage] if self.wall[stage] > 0 else None}
+                for stage in self.wall}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def prepare_windows(tree, maker, nn, fetch_step, max_entries):
+    '''Run the input stages window by window, return the timings and the preprocessed inputs.'''
+    timer = StageTimer()
+    windows = []
+    stop = min(tree.numentries, max_entries) if max_entries else tree.numentries
+    for start in range(0, stop, fetch_step):
+        table = timer.time('uproot_read', tree.arrays, maker.branches(), namedecode='utf-8',
+                           entrystart=start, entrystop=min(start + fetch_step, stop))
+        taginfo = timer.time('feature_conversion', maker.convert, table)
+        data, counts = timer.time('preprocessing', nn._preprocess, taginfo)
+        windows.append((start, data, counts))
+    return timer, windows
+
+
+def run_inference(timer, nn, windows, batch_size):
+    output_names = nn.prep_params['output_names']
+    cache = {}
+    for start, data, counts in windows:
+        njets = len(counts) and int(counts.sum())
+        preds = []
+        for i in range(0, njets, batch_size):
+            batch = {k: v[i:i + batch_size] for k, v in data.items()}
+            preds.append(timer.time('sess_run', nn.sess.run, [], batch)[0])
+        if not preds:
+            continue
+        preds = np.concatenate(preds)
+        # fill the cache the same way `update_cache`/`load_cache` store it, then look up every jet
+        event_idx = np.repeat(np.arange(start, start + len(counts)), counts)
+        jet_idx = np.concatenate([np.arange(c) for c in counts])
+        cache.update({(e, j): dict(zip(output_names, p)) for e, j, p in zip(event_idx, jet_idx, preds)})
+        timer.time('cache_lookup', lambda: [cache.get((e, j)) for e, j in zip(event_idx, jet_idx)])
+
+
+def run_config(args, nthreads, fetch_step, batch_size):
+    '''Benchmark one configuration, run in a fresh process (see `main`) so that the peak RSS is its own.'''
+    tree = uproot.open(args.input)['Events']
+    maker = ParticleNetTagInfoMaker(fatjet_branch=args.jet_branch, jetR=args.jet_r)
+    nn = ParticleNetJetTagsProducer(args.model, args.preprocess, version=args.version, cache_suffix='',
+                                    session_options={'intra_op_num_threads': nthreads,
+                                                     'inter_op_num_threads': 1})
+    timer, windows = prepare_windows(tree, maker, nn, fetch_step, args.max_entries)
+    njets = sum(int(counts.sum()) for _, _, counts in windows)
+    run_inference(timer, nn, windows, batch_size)
+    total_wall = sum(timer.wall.values())
+    res = {'threads': nthreads, 'fetch_step': fetch_step, 'batch_size': batch_size,
+           'njets': njets, 'stages': timer.summary(njets),
+           'total': {'wall': total_wall, 'cpu': sum(timer.cpu.values()),
+                     'jets_per_sec': njets / total_wall if total_wall > 0 else None},
+           'peak_rss_mb': peak_rss_mb()}
+    return res, nn.md5
+
+
+def _int_list(s):
+    return [int(x) for x in s.split(',')]
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser('Benchmark tag-info production and inference throughput')
+    parser.add_argument('-i', '--input', required=True, help='Input NanoAOD file.')
+    parser.add_argument('-m', '--model', required=True, help='ONNX model, may contain `{version}`.')
+    parser.add_argument('-p', '--preprocess', required=True, help='Preprocess json, may contain `{version}`.')
+    parser.add_argument('--version', default='', help='Model version. Default: %(default)s')
+    parser.add_argument('--jet-branch', default='FatJet', help='Default: %(default)s')
+    parser.add_argument('--jet-r', type=float, default=0.8, help='Default: %(default)s')
+    parser.add_argument('--batch-size', type=_int_list, default=[1, 64, 512],
+                        help='Comma separated list of batch sizes. Default: 1,64,512')
+    parser.add_argument('--threads', type=_int_list, default=[1, 2, 4],
+                        help='Comma separated list of onnxruntime intra-op thread counts. Default: 1,2,4')
+    parser.add_argument('--fetch-step', type=_int_list, default=[100, 1000],
+                        help='Comma separated list of fetch windows (events). Default: 100,1000')
+    parser.add_argument('--max-entries', type=int, default=10000,
+                        help='Max number of events to read, 0 for all. Default: %(default)s')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='Output json file. Default: %(default)s')
+    args = parser.parse_args()
+
+    # ru_maxrss only grows: a new process per configuration, forked before any session is created
+    ctx = multiprocessing.get_context('fork')
+    results = []
+    for nthreads in args.threads:
+        for fetch_step in args.fetch_step:
+            for batch_size in args.batch_size:
+                pool = ctx.Pool(1)
+                try:
+                    res, model_md5 = pool.apply(run_config, (args, nthreads, fetch_step, batch_size))
+                finally:
+                    pool.close()
+                    pool.join()
+                results.append(res)
+                print('threads=%d fetch_step=%d batch_size=%d: %d jets, %.1f jets/s, sess.run %.1f jets/s, peak RSS %.0f MB' % (
+                    nthreads, fetch_step, batch_size, res['njets'], res['total']['jets_per_sec'] or 0,
+                    res['stages'].get('sess_run', {}).get('jets_per_sec') or 0, res['peak_rss_mb']))
+
+    summary = {'input': os.path.abspath(args.input),
+               'model': args.model.format(version=args.version),
+               'model_md5': model_md5,
+               'onnxruntime': onnxruntime.__version__,
+               'host': socket.getfqdn(),
+               'cpu_count': os.cpu_count(),
+               'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'results': results}
+    with open(args.output, 'w') as fout:
+        json.dump(summary, fout, indent=2, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,48 @@ from uproot_methods import TLorentzVectorArray
 from collections import Counter
 
 
+class EventsReader(object):
+    '''
+    Reads the `Events` branches needed by one or more tag-info makers, one window of events at a time.
+
+    The makers sharing a reader register their branches with `add_branches`, and the union is read (and the
+    baskets decompressed) once per window instead of once per maker.
+    '''
+
+    def __init__(self, fetch_step=1000, basketcache='200MB'):
+        self.fetch_step = fetch_step
+        self.basketcache_size = basketcache
+        self.branches = []
+        self._file = None
+
+    def add_branches(self, branches):
+        for b in branches:
+            if b not in self.branches:
+                self.branches.append(b)
+
+    def init_file(self, inputFile):
+        if inputFile is self._file:
+            # already opened for another maker
+            return
+        self._file = inputFile
+        self._basketcache = uproot.cache.ThreadSafeArrayCache(self.basketcache_size)
+        self._keycache = uproot.cache.ThreadSafeArrayCache('10MB')
+        # the PostProcessor's input: the local copy if the file was prefetched, otherwise a second remote open
+        self._tree = uproot.open(inputFile.GetName())['Events']
+        self.start = 0
+        self.stop = 0
+        self._table = None
+
+    def load(self, event_idx):
+        if event_idx >= self.stop or event_idx < self.start:
+            self.start = event_idx
+            self.stop = self.start + self.fetch_step
+            self._table = self._tree.arrays(
+                self.branches, namedecode='utf-8', entrystart=self.start, entrystop=self.stop,
+                basketcache=self._basketcache, keycache=self._keycache)
+        return self._table
+
+
 class ParticleNetTagInfoMaker(object):
 
     def __init__(self, fatjet_branch='FatJet', pfcand_branch='PFCands', sv_branch='SV', jetR=0.8, pfcand_ptcut=0):
@@ -92,9 +134,16 @@ class ParticleNetTagInfoMaker(object):
         data['pfcand_btagSip3dSig'] = pf('btagSip3dSig')
         data['pfcand_btagJetDistVal'] = pf('btagJetDistVal')
 
+        self._extra_pfcand_features(data, table, pf, candp4)
         self._finalize_data(data)
         self.data.update(data)
 
+    def _extra_pfcand_features(self, data, table, pf, candp4):
+        pass
+
+    def _extra_sv_features(self, data, table, sv, svp4):
+        pass
+
     def _make_sv(self, table):
         data = {}
         all_svp4 = TLorentzVectorArray.from_ptetaphim(
@@ -126,6 +175,7 @@ class ParticleNetTagInfoMaker(object):
         data['sv_d3d'] = sv('dlen')
         data['sv_d3dsig'] = sv('dlenSig')
         data['sv_costhetasvpv'] = -np.cos(sv('pAngle'))
+        self._extra_sv_features(data, table, sv, svp4)
 
         dxysig = sv('dxySig')
         dxysig.content[~np.isfinite(dxysig.content)] = 0
@@ -151,11 +201,16 @@ class ParticleNetTagInfoMaker(object):
         self.data['_jetp4'] = self.jetp4
         return self.data
 
-    def init_file(self, inputFile, fetch_step=1000):
-        self._uproot_basketcache = uproot.cache.ThreadSafeArrayCache('200MB')
-        self._uproot_keycache = uproot.cache.ThreadSafeArrayCache('10MB')
-        self._uproot_tree = uproot.open(inputFile.GetName())['Events']
-        self._uproot_fetch_step = fetch_step
+    def branches(self):
+        return [self.idx_branch, self.fatjet_branch + '_nPFCand',
+                self.fatjet_branch + '_pt', self.fatjet_branch + '_eta',
+                self.fatjet_branch + '_phi', self.fatjet_branch + '_mass',
+                self.pfcand_branch + '*', self.sv_branch + '*']
+
+    def init_file(self, inputFile, fetch_step=1000, reader=None):
+        self._uproot_reader = reader if reader is not None else EventsReader(fetch_step=fetch_step)
+        self._uproot_reader.add_branches(self.branches())
+        self._uproot_reader.init_file(inputFile)
         self._uproot_start = 0
         self._uproot_stop = 0
         self._taginfo = None
@@ -163,20 +218,61 @@ class ParticleNetTagInfoMaker(object):
     def load(self, event_idx):
         if event_idx >= self._uproot_stop:
             # needs to fetch next batch
-            self._uproot_start = event_idx
-            self._uproot_stop = self._uproot_start + self._uproot_fetch_step
-            table = self._uproot_tree.arrays([
-                self.fatjet_branch + 'ToPFCands_candIdx', self.fatjet_branch + '_nPFCand',
-                self.fatjet_branch + '_pt', self.fatjet_branch + '_eta',
-                self.fatjet_branch + '_phi', self.fatjet_branch + '_mass',
-                'PFCands*', 'SV*'],
-                namedecode='utf-8', entrystart=self._uproot_start, entrystop=self._uproot_stop,
-                basketcache=self._uproot_basketcache, keycache=self._uproot_keycache,
-            )
+            table = self._uproot_reader.load(event_idx)
+            self._uproot_start = self._uproot_reader.start
+            self._uproot_stop = self._uproot_reader.stop
             self._taginfo = self.convert(table)
         return self._taginfo
 
 
+class GlobalParTTagInfoMaker(ParticleNetTagInfoMaker):
+    '''
+    Inputs of the GlobalParT (V3) tagger: charged candidates incl. lost tracks (`cpfcandlt_*`),
+    neutral candidates (`npfcand_*`), SVs (`sv_*`), all with their 4-vectors, and the jet features (`jet_*`).
+    '''
+
+    # not stored in every NanoAOD version, filled with zeros if the branch is missing
+    optional_pfcand_vars = ['isLostTrack',
+                            'pixelBarrelLayersWithMeasurement', 'pixelEndcapLayersWithMeasurement',
+                            'stripTECLayersWithMeasurement', 'stripTIBLayersWithMeasurement',
+                            'stripTIDLayersWithMeasurement', 'stripTOBLayersWithMeasurement']
+
+    def _extra_pfcand_features(self, data, table, pf, candp4):
+        data['pfcand_px'] = candp4.x
+        data['pfcand_py'] = candp4.y
+        data['pfcand_pz'] = candp4.z
+        data['pfcand_energy'] = candp4.t
+        for var in self.optional_pfcand_vars:
+            if self.pfcand_branch + '_' + var in table:
+                data['pfcand_' + var] = pf(var)
+            else:
+                data['pfcand_' + var] = data['pfcand_mask'].zeros_like()
+
+    def _extra_sv_features(self, data, table, sv, svp4):
+        data['sv_px'] = svp4.x
+        data['sv_py'] = svp4.y
+        data['sv_pz'] = svp4.z
+        data['sv_energy'] = svp4.t
+
+    def _jet_feature(self, arr):
+        # one entry per jet, i.e., event -> jet -> [value], to be padded like the candidate features
+        return arr.copy(content=awkward.JaggedArray.fromcounts(
+            np.ones(len(arr.content), dtype='int64'), arr.content.astype('float32')))
+
+    def convert(self, table):
+        super(GlobalParTTagInfoMaker, self).convert(table)
+        charged = self.data['pfcand_charge'] != 0
+        for k in [k for k in self.data if k.startswith('pfcand_')]:
+            var = k[len('pfcand_'):]
+            self.data['cpfcandlt_' + var] = self.data[k][charged]
+            self.data['npfcand_' + var] = self.data[k][~charged]
+            del self.data[k]
+        self.data['jet_pt_log'] = self._jet_feature(np.log(self.jetp4.pt))
+        self.data['jet_mass_log'] = self._jet_feature(np.log(self.jetp4.mass))
+        self.data['jet_eta'] = self._jet_feature(self.jetp4.eta)
+        return self.data
+
+
 if __name__ == '__main__':
     import uproot
     import argparse
@@ -0,0 +1,162 @@
+'''
+In-process merging of NanoAOD-like files.
+
+When all the inputs have the same content (same trees w/ the same branches), the files are merged w/ `TFileMerger`
+in fast mode, i.e., the compressed baskets are copied w/o being decompressed (the output uses the compression
+settings of the first input for that, unless another `compression` is requested, in which case the baskets are
+recompressed). Otherwise, `haddnano.py` is used, which handles branches missing in some of the inputs (and its output
+is rewritten w/ TFileMerger if another `compression` is requested). Long input lists are merged hierarchically, w/ the
+groups merged in parallel. The number of entries of each tree in the output is checked against the sum over the inputs.
+'''
+import os
+import shutil
+import logging
+import subprocess
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+logger = logging.getLogger('merge')
+
+_compression_algos = {'ZLIB': 1, 'LZMA': 2, 'LZ4': 4, 'ZSTD': 5}
+
+
+def compression_setting(spec):
+    '''ROOT compression setting (algorithm * 100 + level) of `none` or `ALGO:level` (e.g., `LZMA:9`, as `--compression`).'''
+    if spec.lower() == 'none':
+        return 0
+    algo, level = spec.split(':')
+    return _compression_algos[algo.upper()] * 100 + int(level)
+
+
+class MergeError(RuntimeError):
+
+    def __init__(self, output, reason, inputs=None, details=None):
+        self.output = output
+        self.reason = reason
+        self.inputs = inputs or []
+        self.details = details or {}
+        msg = 'Failed to merge %d files into %s: %s' % (len(self.inputs), output, reason)
+        if self.details:
+            msg += ' ' + str(self.details)
+        super(MergeError, self).__init__(msg)
+
+
+def file_content(fname):
+    '''Returns ({tree: entries}, {tree: ((branch, type), ...)}, [other keys], compression settings) of a file.'''
+    f = ROOT.TFile.Open(fname)
+    if not f or f.IsZombie():
+        raise MergeError(fname, 'cannot open file')
+    entries, schemas, others = {}, {}, []
+    try:
+        for key in f.GetListOfKeys():
+            name = key.GetName()
+            if name in entries or name in others:
+                continue  # older cycles
+            if key.GetClassName() == 'TTree':
+                tree = key.ReadObj()
+                entries[name] = tree.GetEntries()
+                schemas[name] = tuple((b.GetName(), b.GetTitle()) for b in tree.GetListOfBranches())
+            else:
+                others.append(name)
+        compression = f.GetCompressionSettings()
+    finally:
+        f.Close()
+    return entries, schemas, others, compression
+
+
+def _fast_merge(output, inputs, compression):
+    merger = ROOT.TFileMerger(False, False)
+    merger.SetMsgPrefix('mergeHelper')
+    merger.SetPrintLevel(0)
+    merger.SetFastMethod(True)
+    if not merger.OutputFile(output, 'RECREATE', compression):
+        raise MergeError(output, 'cannot create output file', inputs)
+    for fname in inputs:
+        if not merger.AddFile(fname, False):
+            raise MergeError(output, 'cannot add input file', inputs, {'file': fname})
+    if not merger.Merge():
+        raise MergeError(output, 'TFileMerger failed', inputs)
+
+
+def _haddnano(output, inputs):
+    p = subprocess.Popen(['haddnano.py', output] + list(inputs), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    log = p.communicate()[0].decode('utf-8', 'replace')
+    if p.returncode != 0:
+        raise MergeError(output, 'haddnano.py failed', inputs, {'returncode': p.returncode, 'log': log[-2000:]})
+
+
+def _merge_flat(output, inputs, fast=None, compression=None):
+    contents = [file_content(f) for f in inputs]
+    expected = {}
+    for entries, _, _, _ in contents:
+        for name, n in entries.items():
+            expected[name] = expected.get(name, 0) + n
+    if fast is None:
+        # same trees and branches everywhere, and nothing but trees
+        fast = all(c[1] == contents[0][1] and not c[2] for c in contents)
+    if compression is None:
+        compression = contents[0][3]
+    if len(inputs) == 1 and compression == contents[0][3]:
+        # nothing to merge, a plain copy keeps the file as is
+        shutil.copyfile(inputs[0], output)
+    elif fast:
+        # TFileMerger switches to the slow (recompressing) mode by itself if the compression changes
+        _fast_merge(output, inputs, compression)
+    else:
+        logger.info('Inputs of %s have different content, merging w/ haddnano.py' % output)
+        _haddnano(output, inputs)
+        if file_content(output)[3] != compression:
+            # haddnano.py keeps the compression of the inputs: one more pass w/ the requested one
+            tmp = '%s.%d.haddnano.root' % (os.path.splitext(output)[0], os.getpid())
+            os.rename(output, tmp)
+            try:
+                _fast_merge(output, [tmp], compression)
+            finally:
+                os.remove(tmp)
+
+    entries = file_content(output)[0]
+    mismatch = {name: (entries.get(name), n) for name, n in expected.items() if entries.get(name) != n}
+    if mismatch:
+        raise MergeError(output, 'entry count mismatch (output, inputs)', inputs, mismatch)
+    return entries
+
+
+def _merge_group(task):
+    output, inputs = task
+    return _merge_flat(output, inputs)
+
+
+def merge_files(output, inputs, nproc=1, fanout=50, compression=None):
+    '''
+    Merge `inputs` into `output`, raise MergeError on failure. Lists longer than `fanout` are merged in groups
+    first (`nproc` groups in parallel), then the intermediate files are merged. The output gets the `compression`
+    setting (see `compression_setting`) if given, otherwise the one of the inputs. Returns {tree: entries} of the output.
+    '''
+    inputs = list(inputs)
+    if len(inputs) == 0:
+        raise MergeError(output, 'no input files')
+    if len(inputs) <= fanout:
+        return _merge_flat(output, inputs, compression=compression)
+
+    groups = [inputs[i:i + fanout] for i in range(0, len(inputs), fanout)]
+    # the number of inputs keeps the names of the intermediate files distinct between the levels
+    tasks = [('%s.%d_%d_%d.root' % (os.path.splitext(output)[0], os.getpid(), len(inputs), idx), group)
+             for idx, group in enumerate(groups)]
+    try:
+        if nproc > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(nproc, len(tasks)))
+            try:
+                pool.map(_merge_group, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for task in tasks:
+                _merge_group(task)
+        # the intermediate files keep the compression of the inputs, only the last level changes it
+        return merge_files(output, [t[0] for t in tasks], nproc=nproc, fanout=fanout, compression=compression)
+    finally:
+        for tmp, _ in tasks:
+            if os.path.exists(tmp):
+                os.remove(tmp)
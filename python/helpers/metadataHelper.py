@@ -0,0 +1,151 @@
+'''
+SQLite store of the job metadata of a jobdir.
+
+Instead of one json w/ everything, the options, the samples (w/ their input files) and the jobs are kept in separate
+tables, one row per sample/job, so a job on the worker node loads only its own row. This store is transferred to the
+jobs and is never written after it is created.
+
+The status parsed from the job logs and the per-job metrics (memory, runtime, stage-out) change while the jobs run,
+so they are kept in a separate `JobStatusStore` that stays on the submit side.
+'''
+import os
+import json
+import sqlite3
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS options (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS samples (name TEXT PRIMARY KEY, pos INTEGER, inputfiles TEXT);
+CREATE TABLE IF NOT EXISTS jobs (jobid INTEGER PRIMARY KEY, samp TEXT, idx INTEGER, info TEXT);
+CREATE INDEX IF NOT EXISTS jobs_samp ON jobs (samp);
+'''
+
+_status_schema = '''
+CREATE TABLE IF NOT EXISTS status (jobid INTEGER PRIMARY KEY, inode INTEGER, offset INTEGER, finished INTEGER, errormsg TEXT);
+CREATE TABLE IF NOT EXISTS metrics (jobid INTEGER PRIMARY KEY, log_inode INTEGER, log_size INTEGER,
+                                    memory_mb INTEGER, runtime REAL, returncode INTEGER,
+                                    stageout_seconds REAL, stageout_mb REAL);
+'''
+
+_metrics_columns = ('log_inode', 'log_size', 'memory_mb', 'runtime', 'returncode', 'stageout_seconds', 'stageout_mb')
+
+
+class MetadataStore(object):
+
+    def __init__(self, path, readonly=True):
+        if not os.path.exists(path):
+            raise IOError('Metadata file %s does not exist' % path)
+        self.path = path
+        if readonly:
+            self.conn = sqlite3.connect('file:%s?mode=ro' % os.path.abspath(path), uri=True)
+        else:
+            self.conn = sqlite3.connect(path, timeout=60)
+
+    @classmethod
+    def create(cls, path, md):
+        '''Write the metadata dict (see `create_metadata`) into a new store at `path`.'''
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        conn = sqlite3.connect(tmp_path)
+        with conn:
+            conn.executescript(_schema)
+            conn.executemany('INSERT INTO options VALUES (?, ?)',
+                             [(k, json.dumps(v)) for k, v in md.items() if k not in ('samples', 'inputfiles', 'jobs')])
+            conn.executemany('INSERT INTO samples VALUES (?, ?, ?)',
+                             [(samp, pos, json.dumps(md['inputfiles'][samp])) for pos, samp in enumerate(md['samples'])])
+            conn.executemany('INSERT INTO jobs VALUES (?, ?, ?, ?)',
+                             [(jobid, job['samp'], job['idx'], json.dumps(job)) for jobid, job in enumerate(md['jobs'])])
+        conn.close()
+        os.rename(tmp_path, path)
+        return cls(path)
+
+    def close(self):
+        self.conn.close()
+
+    def options(self):
+        return {k: json.loads(v) for k, v in self.conn.execute('SELECT key, value FROM options')}
+
+    def option(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM options WHERE key=?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def samples(self):
+        return [r[0] for r in self.conn.execute('SELECT name FROM samples ORDER BY pos')]
+
+    def inputfiles(self, samp):
+        row = self.conn.execute('SELECT inputfiles FROM samples WHERE name=?', (samp,)).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def njobs(self):
+        return self.conn.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+
+    def job(self, jobid):
+        row = self.conn.execute('SELECT info FROM jobs WHERE jobid=?', (int(jobid),)).fetchone()
+        if row is None:
+            raise KeyError('No job %s in %s' % (jobid, self.path))
+        return json.loads(row[0])
+
+    def jobs(self, samp=None):
+        '''List of the jobs (ordered by jobid), or {jobid: job} of the jobs of sample `samp`.'''
+        if samp is None:
+            return [json.loads(r[0]) for r in self.conn.execute('SELECT info FROM jobs ORDER BY jobid')]
+        return {r[0]: json.loads(r[1]) for r in self.conn.execute(
+            'SELECT jobid, info FROM jobs WHERE samp=? ORDER BY jobid', (samp,))}
+
+    def job_metadata(self, jobid):
+        '''The options and the single job `jobid`, in the layout of the metadata dict (`md['jobs'][jobid]`).'''
+        md = self.options()
+        md['jobs'] = {int(jobid): self.job(jobid)}
+        return md
+
+    def to_dict(self):
+        md = self.options()
+        md['samples'] = self.samples()
+        md['inputfiles'] = {samp: json.loads(files) for samp, files in self.conn.execute(
+            'SELECT name, inputfiles FROM samples')}
+        md['jobs'] = self.jobs()
+        return md
+
+
+class JobStatusStore(object):
+    '''Status and metrics of the jobs of a jobdir, harvested from the job logs on the submit side.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.executescript(_status_schema)
+        self._add_missing_columns()
+
+    def _add_missing_columns(self):
+        # stores created before some metrics were added
+        existing = set(r[1] for r in self.conn.execute('PRAGMA table_info(metrics)'))
+        with self.conn:
+            for col in _metrics_columns:
+                if col not in existing:
+                    self.conn.execute('ALTER TABLE metrics ADD COLUMN %s REAL' % col)
+
+    def close(self):
+        self.conn.close()
+
+    def status(self):
+        '''{jobid: {'inode', 'offset', 'finished', 'errormsg'}} of the job logs parsed so far.'''
+        return {r[0]: {'inode': r[1], 'offset': r[2], 'finished': bool(r[3]), 'errormsg': r[4]}
+                for r in self.conn.execute('SELECT jobid, inode, offset, finished, errormsg FROM status')}
+
+    def update_status(self, entries, removed=()):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?, ?)',
+                                  [(jobid, e['inode'], e['offset'], int(e['finished']), e['errormsg'])
+                                   for jobid, e in entries.items()])
+            self.conn.executemany('DELETE FROM status WHERE jobid=?', [(jobid,) for jobid in removed])
+
+    def metrics(self):
+        '''{jobid: {column: value}} of the metrics harvested from the job logs, see `_metrics_columns`.'''
+        return {r[0]: dict(zip(_metrics_columns, r[1:]))
+                for r in self.conn.execute('SELECT jobid, %s FROM metrics' % ', '.join(_metrics_columns))}
+
+    def update_metrics(self, entries):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO metrics (jobid, %s) VALUES (?, %s)' % (
+                                  ', '.join(_metrics_columns), ', '.join('?' * len(_metrics_columns))),
+                                  [(jobid,) + tuple(m.get(col) for col in _metrics_columns)
+                                   for jobid, m in entries.items()])
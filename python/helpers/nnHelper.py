@@ -1,3 +1,8 @@
+import numpy as np
+
+_qcd_classes = ['QCDbb', 'QCDb', 'QCDcc', 'QCDc', 'QCDothers']
+
+
 def convert_prob(jet, sigs, bkgs=None, prefix=''):
     if not jet:
         return -1
@@ -30,6 +35,65 @@ def convert_prob(jet, sigs, bkgs=None, prefix=''):
         return -1
 
 
-def ensemble(outputs, func):
-    keys = outputs[0].keys()
-    return {k: func([o[k] for o in outputs]) for k in keys}
+def ensemble(outputs, func, output_names=None):
+    if output_names is None:
+        keys = outputs[0].keys()
+        return {k: func([o[k] for o in outputs]) for k in keys}
+    else:
+        # stacked outputs of shape (n_models, n_outputs): reduce over the models in one go
+        return dict(zip(output_names, func(outputs, axis=0)))
+
+
+class ScoreCombiner(object):
+    '''
+    Vectorized version of `convert_prob` for a batch of jets.
+
+    `columns` are the (prefixed) class names of the columns of the score matrix, `discriminants` maps each
+    discriminant to its `(sigs, bkgs)` class names, w/ the same conventions as `convert_prob`: `bkgs=None`
+    means the QCD classes, `sigs=None` returns the sum of the backgrounds. The class names are resolved
+    once into selection matrices, so all the discriminants are computed w/ two matrix products.
+    '''
+
+    def __init__(self, columns, discriminants, prefix=''):
+        self.columns = list(columns)
+        self.names = list(discriminants)
+        col_idx = {c: i for i, c in enumerate(self.columns)}
+        self._sig = np.zeros((len(self.columns), len(self.names)))
+        self._bkg = np.zeros((len(self.columns), len(self.names)))
+        self._bkg_only = np.zeros(len(self.names), dtype=bool)
+        for k, name in enumerate(self.names):
+            sigs, bkgs = discriminants[name]
+            if bkgs is None:
+                bkgs = _qcd_classes
+            for n in bkgs:
+                self._bkg[col_idx[prefix + n], k] = 1
+            if sigs is None:
+                self._bkg_only[k] = True
+            else:
+                for n in sigs:
+                    self._sig[col_idx[prefix + n], k] = 1
+
+    def __call__(self, scores):
+        '''Returns a dict of arrays of shape (n_jets,) from scores of shape (n_jets, n_columns).'''
+        scores = np.atleast_2d(np.asarray(scores, dtype='float64'))
+        sigsum = scores.dot(self._sig)
+        bkgsum = scores.dot(self._bkg)
+        denom = sigsum + bkgsum
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = np.where(denom != 0, sigsum / denom, -1)
+        out[:, self._bkg_only] = bkgsum[:, self._bkg_only]
+        return {name: out[:, k] for k, name in enumerate(self.names)}
+
+
+def bb_vs_top(hbb_vs_qcd, top_vs_qcd):
+    '''
+    bb vs top discriminant from the XvsQCD ones: 1 / (1 + T / Hbb * (1 - Hbb) / (1 - T)),
+    0 if undefined (Hbb == 0 or T == 1).
+    '''
+    hbb = np.asarray(hbb_vs_qcd, dtype='float64')
+    top = np.asarray(top_vs_qcd, dtype='float64')
+    num = hbb * (1 - top)
+    denom = num + top * (1 - hbb)
+    valid = (hbb != 0) & (top != 1) & (denom != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(valid, num / denom, 0)
@@ -6,6 +6,8 @@ import json
 import pandas as pd
 import traceback
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from .makeInputs import ParticleNetTagInfoMaker
 
@@ -70,20 +72,162 @@ def _pad(a, min_length, max_length, value=0, dtype='float32'):
 logger = logging.getLogger('NanoNN')
 configLogger('NanoNN', loglevel=logging.INFO)
 
+_graph_optimization_levels = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+_execution_modes = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def optimized_model_path(model_path, model_md5, level):
+    return '%s.%s.%s.ort%s.onnx' % (os.path.splitext(model_path)[0], model_md5, level, onnxruntime.__version__)
+
+
+def make_session(model_path, model_md5, session_options=None):
+    '''
+    Create an InferenceSession configured from a dict with the (optional) keys
+    `intra_op_num_threads`, `inter_op_num_threads`, `graph_optimization_level`
+    (disable|basic|extended|all), `execution_mode` (sequential|parallel) and
+    `cache_optimized_model` (bool).
+
+    The optimized graph is serialized next to the model, keyed by the model md5, the optimization level
+    and the onnxruntime version, and is loaded directly by later jobs. Only optimizations up to `extended`
+    are stored, as the layout transformations of `all` depend on the CPU of the node that runs them;
+    they are (cheaply) reapplied online when `all` is requested.
+    '''
+    opts = dict(session_options or {})
+    level = opts.get('graph_optimization_level', 'all')
+    if level not in _graph_optimization_levels:
+        raise ValueError('Invalid graph optimization level: %s' % str(level))
+    so = onnxruntime.SessionOptions()
+    if opts.get('intra_op_num_threads'):
+        so.intra_op_num_threads = int(opts['intra_op_num_threads'])
+    if opts.get('inter_op_num_threads'):
+        so.inter_op_num_threads = int(opts['inter_op_num_threads'])
+    if opts.get('execution_mode'):
+        so.execution_mode = _execution_modes[opts['execution_mode']]
+    so.graph_optimization_level = _graph_optimization_levels[level]
+
+    if level == 'disable' or not opts.get('cache_optimized_model', True):
+        return onnxruntime.InferenceSession(model_path, sess_options=so)
+
+    cache_level = 'basic' if level == 'basic' else 'extended'
+    cache_path = optimized_model_path(model_path, model_md5, cache_level)
+    if os.path.exists(cache_path):
+        if level != 'all':
+            so.graph_optimization_level = _graph_optimization_levels['disable']
+        try:
+            sess = onnxruntime.InferenceSession(cache_path, sess_options=so)
+            logger.info('Loaded optimized model %s' % cache_path)
+            return sess
+        except Exception:
+            logger.warning('Cannot load the optimized model %s -- Will optimize from scratch...' % cache_path)
+            so.graph_optimization_level = _graph_optimization_levels[level]
+
+    if not os.access(os.path.dirname(os.path.abspath(cache_path)), os.W_OK):
+        return onnxruntime.InferenceSession(model_path, sess_options=so)
+
+    # write the cached graph w/ a separate session so that `so` keeps the requested level
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    cache_so = onnxruntime.SessionOptions()
+    cache_so.graph_optimization_level = _graph_optimization_levels[cache_level]
+    cache_so.optimized_model_filepath = tmp_path
+    try:
+        onnxruntime.InferenceSession(model_path, sess_options=cache_so)
+        os.rename(tmp_path, cache_path)  # atomic, concurrent jobs may write the same file
+        logger.info('Saved optimized model to %s' % cache_path)
+    except Exception:
+        logger.warning('Cannot save the optimized model:\n%s' % traceback.format_exc())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return onnxruntime.InferenceSession(model_path, sess_options=so)
+
+
+def reduced_precision_model(model_path, model_md5, precision):
+    '''
+    Return the path of the model converted to `precision`: fp32 (the model itself), fp16 (weights and
+    activations in half precision, fp32 inputs/outputs kept) or int8 (dynamic quantization of the weights).
+    The converted model is stored next to the original one, keyed by the md5 of the original model.
+    '''
+    if precision == 'fp32':
+        return model_path
+    if precision not in ('fp16', 'int8'):
+        raise ValueError('Invalid precision: %s' % str(precision))
+    out_path = '%s.%s.%s.onnx' % (os.path.splitext(model_path)[0], model_md5, precision)
+    if not os.access(os.path.dirname(os.path.abspath(out_path)), os.W_OK):
+        import tempfile
+        out_path = os.path.join(tempfile.gettempdir(), os.path.basename(out_path))
+    if os.path.exists(out_path):
+        return out_path
+
+    logger.info('Converting model %s to %s' % (model_path, precision))
+    tmp_path = '%s.%d.tmp' % (out_path, os.getpid())
+    if precision == 'int8':
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8)
+    else:
+        import onnx
+        from onnxconverter_common import float16
+        onnx.save(float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True), tmp_path)
+    os.rename(tmp_path, out_path)
+    return out_path
+
+
+_model_md5s = {}
+_model_sessions = {}
+_model_registry_lock = threading.Lock()
+
+
+def model_file_md5(model_path):
+    '''md5 of the model file, computed once per process (and recomputed if the file changes).'''
+    st = os.stat(model_path)
+    key = (os.path.realpath(model_path), st.st_size, st.st_mtime)
+    with _model_registry_lock:
+        if key not in _model_md5s:
+            _model_md5s[key] = md5(model_path)
+        return _model_md5s[key]
+
+
+def load_model(model_path, session_options=None, precision='fp32'):
+    '''
+    Return `(md5, session)` for the model, loaded once per process for each set of session options and
+    precision and shared among all the producers (`InferenceSession.run` is thread-safe).
+    For reduced precisions the md5 is suffixed with the precision to keep the prediction caches apart.
+    '''
+    orig_md5 = model_file_md5(model_path)
+    key = (orig_md5, json.dumps(session_options or {}, sort_keys=True), precision)
+    with _model_registry_lock:
+        if key not in _model_sessions:
+            path, sess_md5 = model_path, orig_md5
+            if precision != 'fp32':
+                path = reduced_precision_model(model_path, orig_md5, precision)
+                sess_md5 = '%s_%s' % (orig_md5, precision)
+            logger.info('Loading model %s' % path)
+            _model_sessions[key] = (sess_md5, make_session(path, sess_md5, session_options))
+        else:
+            logger.info('Reusing the loaded model %s' % model_path)
+        return _model_sessions[key]
+
 
 class ParticleNetJetTagsProducer(object):
 
-    def __init__(self, model_path, preprocess_path, version, cache_suffix, debug=False):
+    def __init__(self, model_path, preprocess_path, version, cache_suffix, session_options=None,
+                 precision='fp32', debug=False):
         self.debug = debug
         model_path = model_path.format(version=version)
         preprocess_path = preprocess_path.format(version=version)
         with open(preprocess_path) as fp:
             self.prep_params = json.load(fp)
-        logger.info('Loading model %s' % model_path)
-        self.sess = onnxruntime.InferenceSession(model_path)
+        self.precision = precision
+        self.md5, self.sess = load_model(model_path, session_options, precision)
         self.ver = version
         self.cache_suffix = cache_suffix
-        self.md5 = md5(model_path)
 
     def _preprocess(self, taginfo, eval_flags=None):
         data = {}
@@ -91,6 +235,7 @@ class ParticleNetJetTagsProducer(object):
         for group_name in self.prep_params['input_names']:
             data[group_name] = []
             info = self.prep_params[group_name]
+            length = info.get('var_length')
             for var in info['var_names']:
                 a = taginfo[var].copy()
                 if eval_flags is not None:
@@ -100,7 +245,11 @@ class ParticleNetJetTagsProducer(object):
                 else:
                     assert(np.array_equal(counts, a.counts))
                 a = (a - info['var_infos'][var]['median']) * info['var_infos'][var]['norm_factor']
-                a = a.flatten().pad(info['var_length'], clip=True).fillna(0).regular()
+                a = a.flatten()
+                if length is None:
+                    # pad to the longest jet in the batch, within [min_length, max_length]
+                    length = int(np.clip(a.counts.max() if len(a) else 0, info['min_length'], info['max_length']))
+                a = a.pad(length, clip=True).fillna(0).regular()
                 a = np.clip(a, info['var_infos'][var].get('lower_bound', -5),
                             info['var_infos'][var].get('upper_bound', 5))
                 if self.debug:
@@ -109,9 +258,20 @@ class ParticleNetJetTagsProducer(object):
             data[group_name] = np.nan_to_num(np.stack(data[group_name], axis=1))
         return data, counts
 
-    def predict(self, taginfo, eval_flags=None):
+    def predict_array(self, taginfo, eval_flags=None, batch_size=None):
+        '''Returns the outputs as an array of shape (n_jets, n_outputs), and the number of jets per event.'''
         data, counts = self._preprocess(taginfo, eval_flags)
-        preds = self.sess.run([], data)[0]
+        njets = int(counts.sum())
+        if njets == 0:
+            return np.zeros((0, len(self.prep_params['output_names'])), dtype='float32'), counts
+        if not batch_size or njets <= batch_size:
+            return self.sess.run([], data)[0], counts
+        preds = [self.sess.run([], {k: v[i:i + batch_size] for k, v in data.items()})[0]
+                 for i in range(0, njets, batch_size)]
+        return np.concatenate(preds), counts
+
+    def predict(self, taginfo, eval_flags=None):
+        preds, counts = self.predict_array(taginfo, eval_flags)
         outputs = {
             flav: awkward.JaggedArray.fromcounts(counts, preds[:, i]) for i,
             flav in enumerate(self.prep_params['output_names'])}
@@ -195,6 +355,119 @@ class ParticleNetJetTagsProducer(object):
         return outputs
 
 
+class BatchedJetTagsProducer(ParticleNetJetTagsProducer):
+    '''
+    Evaluates the jets in the current fetch window of the tag-info maker at once, then serves them per jet.
+
+    `eval_flags(taginfo, start)` returns the jets of the window (starting at entry `start`) worth evaluating, as a
+    jagged boolean array: only those are batched. A jet that was not flagged is evaluated on its own if requested.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.batch_size = kwargs.pop('batch_size', 256)
+        self.eval_flags = kwargs.pop('eval_flags', None)
+        super(BatchedJetTagsProducer, self).__init__(*args, **kwargs)
+        self.output_names = self.prep_params['output_names']
+        self._window_start = None
+
+    def init_file(self):
+        self._window_start = None
+
+    def predict_batched(self, taginfo_producer, event_idx, jet_idx):
+        '''Returns the outputs of one jet as an array ordered as `output_names`.'''
+        taginfo = taginfo_producer.load(event_idx)
+        if self._window_start != taginfo_producer._uproot_start:
+            self._window_start = taginfo_producer._uproot_start
+            flags = self.eval_flags(taginfo, self._window_start) if self.eval_flags is not None else None
+            self._window_preds, _ = self.predict_array(taginfo, eval_flags=flags, batch_size=self.batch_size)
+            counts = taginfo['_jetp4'].counts
+            selected = np.ones(int(counts.sum()), dtype=bool) if flags is None else np.asarray(flags.flatten(), dtype=bool)
+            # row of each jet of the window in the predictions, -1 if not evaluated
+            self._window_rows = np.where(selected, np.cumsum(selected) - 1, -1)
+            self._window_offsets = np.cumsum(counts) - counts
+        row = self._window_rows[self._window_offsets[event_idx - self._window_start] + jet_idx]
+        if row < 0:
+            outputs = self.predict_one(taginfo, event_idx - self._window_start, jet_idx)
+            return np.array([outputs[name] for name in self.output_names], dtype='float32')
+        return self._window_preds[row]
+
+
+class ParticleNetEnsemble(object):
+    '''
+    Runs several versions of the same model and stacks their outputs, concurrently on `nthreads` threads
+    (default, None: one per version). `nthreads=1` runs them one after the other in the calling thread.
+    Call `close` once done to stop the threads.
+    '''
+
+    def __init__(self, producers, nthreads=None):
+        self.producers = producers
+        self.output_names = producers[0].prep_params['output_names']
+        for p in producers[1:]:
+            if p.prep_params['output_names'] != self.output_names:
+                raise RuntimeError('Inconsistent outputs in the ensemble: %s (%s) vs %s (%s)' % (
+                    producers[0].ver, str(self.output_names), p.ver, str(p.prep_params['output_names'])))
+        if nthreads is None:
+            nthreads = len(producers)
+        self._executor = None
+        if nthreads > 1 and len(producers) > 1:
+            self._executor = ThreadPoolExecutor(max_workers=nthreads)
+
+    def __len__(self):
+        return len(self.producers)
+
+    def __iter__(self):
+        return iter(self.producers)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def load_cache(self, inputFile):
+        for p in self.producers:
+            p.load_cache(inputFile)
+
+    def update_cache(self):
+        for p in self.producers:
+            p.update_cache()
+
+    def _is_cached(self, event_idx, jet_idx):
+        return all(p._cache_df is not None and (event_idx, jet_idx) in p._cache_dict for p in self.producers)
+
+    def predict_with_cache(self, taginfo_producer, event_idx, jet_idx, jet=None):
+        '''Returns an array of shape (n_models, n_outputs), columns ordered as `output_names`.'''
+        if not self._is_cached(event_idx, jet_idx):
+            # fetch the tag info in the calling thread as the uproot reader is not thread-safe,
+            # the workers then only read from the already converted arrays
+            taginfo_producer.load(event_idx)
+        if self._executor is None:
+            outputs = [p.predict_with_cache(taginfo_producer, event_idx, jet_idx, jet) for p in self.producers]
+        else:
+            futures = [self._executor.submit(p.predict_with_cache, taginfo_producer, event_idx, jet_idx, jet)
+                       for p in self.producers]
+            outputs = [f.result() for f in futures]
+        return np.array([[o[k] for k in self.output_names] for o in outputs], dtype='float32')
+
+
+def report_deviations(ref, test, output_names, title):
+    '''Percentiles of the per-jet deviations for each output node (relative ones for the regressed mass).'''
+    print('--- %s ---' % title)
+    print('%-20s %12s %12s %12s %12s' % ('output', '50%', '95%', '99%', '100%'))
+    report = {}
+    for name in output_names:
+        a = np.asarray(ref[name].content, dtype='float64')
+        b = np.asarray(test[name].content, dtype='float64')
+        if name == 'mass':
+            diff = np.abs(b - a) / np.maximum(np.abs(a), 1e-6)
+            label = name + ' (rel.)'
+        else:
+            diff = np.abs(b - a)
+            label = name
+        report[name] = np.percentile(diff, [50, 95, 99, 100]).tolist()
+        print('%-20s %12.3g %12.3g %12.3g %12.3g' % tuple([label] + report[name]))
+    return report
+
+
 if __name__ == '__main__':
     import time
     import uproot
@@ -203,45 +476,54 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--input')
     parser.add_argument('-m', '--model')
     parser.add_argument('-p', '--preprocess')
+    parser.add_argument('--jet-branch', default='FatJet')
+    parser.add_argument('--jet-r', type=float, default=0.8)
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'fp16', 'int8'],
+                        help='Also run the model at reduced precision and report the deviations w.r.t. fp32.')
+    parser.add_argument('--report', default=None, help='Write the deviation percentiles to this json file.')
     parser.add_argument('--make_baseline', action='store_true')
     args = parser.parse_args()
 
-    p = ParticleNetTagInfoMaker()
+    p = ParticleNetTagInfoMaker(fatjet_branch=args.jet_branch, jetR=args.jet_r)
     tree = uproot.open(args.input)['Events']
-    table = tree.arrays(['FatJet*', 'PFCands*', 'SV*'], namedecode='utf-8')
+    table = tree.arrays([args.jet_branch + '*', 'PFCands*', 'SV*'], namedecode='utf-8')
     start = time.time()
     taginfo = p.convert(table)
     diff = time.time() - start
     print('--- Convert inputs: %f s total, %f s per jet ---' % (diff, diff / taginfo['pfcand_mask'].counts.sum()))
-#     for k in taginfo:
-#         print(k, taginfo[k])
 
-#     jetmass = tree.array('FatJet_msoftdrop')
-#     eval_flags = (jetmass > 50) * (jetmass < 200)
-#     jetmass = jetmass[eval_flags]
     eval_flags = None
 
-    start = time.time()
-    nn = ParticleNetJetTagsProducer(args.model, args.preprocess)
-    diff = time.time() - start
-    print('--- Setup model: %f s total' % (diff,))
+    def run_model(precision):
+        start = time.time()
+        nn = ParticleNetJetTagsProducer(args.model, args.preprocess, version='', cache_suffix='', precision=precision)
+        diff = time.time() - start
+        print('--- Setup %s model: %f s total' % (precision, diff,))
 
-    start = time.time()
-    outputs = nn.predict(taginfo, eval_flags)
-    diff = time.time() - start
-    print('--- Run prediction: %f s total, %f s per jet ---' % (diff, diff / outputs['probQCDbb'].counts.sum()))
-#     print(outputs)
-#     for k in outputs:
-#         print(k, outputs[k].content.mean())
+        start = time.time()
+        outputs = nn.predict(taginfo, eval_flags)
+        diff = time.time() - start
+        njets = outputs[nn.prep_params['output_names'][0]].counts.sum()
+        print('--- Run %s prediction: %f s total, %f s per jet, %.1f jets/s ---' %
+              (precision, diff, diff / njets, njets / diff))
+        return nn, outputs
 
-    if 'FatJet_ParticleNetMD_probXbb' in table:
+    nn, outputs = run_model('fp32')
+    output_names = nn.prep_params['output_names']
+    report = {}
+
+    if args.precision != 'fp32':
+        _, outputs_reduced = run_model(args.precision)
+        report[args.precision + '_vs_fp32'] = report_deviations(
+            outputs, outputs_reduced, output_names, 'Deviation of %s w.r.t. fp32' % args.precision)
+
+    if 'probXbb' in outputs and args.jet_branch + '_ParticleNetMD_probXbb' in table:
         print('Compare w/ stored values')
-        print('Stored values:\n ...', table['FatJet_ParticleNetMD_probXbb'][:5])
+        print('Stored values:\n ...', table[args.jet_branch + '_ParticleNetMD_probXbb'][:5])
         print('Computed values:\n ...', outputs['probXbb'][:5])
         print('Diff (50%, 95%, 99%, 100%) = ', np.percentile(
-            np.abs(outputs['probXbb'] - table['FatJet_ParticleNetMD_probXbb']).content, [50, 95, 99, 100]))
+            np.abs(outputs['probXbb'] - table[args.jet_branch + '_ParticleNetMD_probXbb']).content, [50, 95, 99, 100]))
 
-#     assert(np.array_equal(jetmass.counts, outputs['probQCDbb'].counts))
     alloutputs = awkward.JaggedArray.zip(outputs)
     if args.make_baseline:
         with open('baseline.awkd', 'wb') as fout:
@@ -251,3 +533,12 @@ if __name__ == '__main__':
             with open('baseline.awkd', 'rb') as fin:
                 baseline = awkward.load(fin)
             print("Comparison to baseline:", (alloutputs == baseline).all().all())
+            report['fp32_vs_baseline'] = report_deviations(
+                baseline, outputs, output_names, 'Deviation of fp32 w.r.t. baseline')
+            if args.precision != 'fp32':
+                report[args.precision + '_vs_baseline'] = report_deviations(
+                    baseline, outputs_reduced, output_names, 'Deviation of %s w.r.t. baseline' % args.precision)
+
+    if args.report:
+        with open(args.report, 'w') as fout:
+            json.dump(report, fout, indent=2, sort_keys=True)
@@ -0,0 +1,79 @@
+'''
+Sums of generator weights of the `Runs` tree, used to normalize the xsec and the LHE weights.
+
+The sums are computed in a single pass over the `Runs` entries, and can be stored in a json sidecar next to
+each job output, so the normalizations of a sample are obtained by adding up the sidecars of its jobs.
+'''
+import json
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+
+def runs_sumw(runs_tree):
+    '''
+    Returns {'genEventSumw': float, 'LHEScaleSumw': [...], 'LHEPdfSumw': [...]}, where the LHE ones are the sums of
+    `LHE*Sumw[i] * genEventSumw` (i.e., the sums of the LHE weights), or None if there are no generator weights (data).
+    '''
+    if not runs_tree or not runs_tree.GetBranch('genEventSumw'):
+        return None
+    sumw = {'genEventSumw': 0.}
+    lhe_names = [name for name in ('LHEScaleSumw', 'LHEPdfSumw') if runs_tree.GetBranch(name)]
+    for name in lhe_names:
+        sumw[name] = None
+    for i in range(runs_tree.GetEntries()):
+        runs_tree.GetEntry(i)
+        w = float(runs_tree.genEventSumw)
+        sumw['genEventSumw'] += w
+        for name in lhe_names:
+            values = [float(v) * w for v in getattr(runs_tree, name)]
+            if sumw[name] is None:
+                sumw[name] = values
+            elif len(values) != len(sumw[name]):
+                raise RuntimeError('Inconsistent number of %s in the Runs tree: %d vs %d' % (name, len(values), len(sumw[name])))
+            else:
+                sumw[name] = [a + b for a, b in zip(sumw[name], values)]
+    return sumw
+
+
+def file_sumw(fname):
+    f = ROOT.TFile.Open(fname)
+    try:
+        return runs_sumw(f.Get('Runs'))
+    finally:
+        f.Close()
+
+
+def merge_sumw(sumws):
+    '''
+    Adds up the sums of weights of several files. A `None` LHE sum (an empty `Runs` tree, e.g., of a job processing
+    a later entry range of a file) counts as no contribution.
+    '''
+    total = None
+    for sumw in sumws:
+        if total is None:
+            total = {k: (list(v) if isinstance(v, list) else v) for k, v in sumw.items()}
+            continue
+        if set(sumw) != set(total):
+            raise RuntimeError('Inconsistent sums of weights: %s vs %s' % (sorted(sumw), sorted(total)))
+        for k, v in sumw.items():
+            if v is None:
+                continue
+            elif total[k] is None:
+                total[k] = list(v) if isinstance(v, list) else v
+            elif isinstance(v, list):
+                if len(v) != len(total[k]):
+                    raise RuntimeError('Inconsistent number of %s: %d vs %d' % (k, len(v), len(total[k])))
+                total[k] = [a + b for a, b in zip(total[k], v)]
+            else:
+                total[k] += v
+    return total
+
+
+def write_sumw(sumw, fname):
+    with open(fname, 'w') as fout:
+        json.dump(sumw, fout)
+
+
+def read_sumw(fname):
+    with open(fname) as fin:
+        return json.load(fin)
@@ -0,0 +1,369 @@
+'''
+Access to remote (xrootd) input files.
+
+`RedirectorSelector` probes a list of candidate redirectors w/ the first input file of a job (open latency and read
+throughput), ranks them, and fails over to the next one when a read fails. Inputs read directly via xrootd are checked
+w/ `open_with_failover` before they are processed (see `FailoverInputs`).
+
+`FilePrefetcher` is passed to the PostProcessor as its list of input files: while file i is being processed, the next
+file(s) are copied to the local scratch in a background thread, so the network transfer overlaps w/ the processing.
+
+`StageOut` copies the outputs of a job in the background w/ checksum verification and exponential backoff.
+
+The probing can be checked against a local stand-in server, e.g., `xrootd -p 1094 <dir w/ a store/ tree>`:
+    python -m PhysicsTools.NanoHRTTools.helpers.xrootdHelper /store/... -r root://localhost:1094/,root://cmsxrootd.fnal.gov/
+'''
+import os
+import re
+import time
+import shutil
+import threading
+import subprocess
+
+
+def default_redirectors(host=None):
+    '''Candidate redirectors, the regional one of the host first.'''
+    if host is None:
+        import socket
+        host = socket.getfqdn()
+    if 'cern.ch' in host:
+        return ['root://xrootd-cms.infn.it/', 'root://cms-xrd-global.cern.ch/', 'root://cmsxrootd.fnal.gov/']
+    return ['root://cmsxrootd.fnal.gov/', 'root://cms-xrd-global.cern.ch/', 'root://xrootd-cms.infn.it/']
+
+
+def redirector_url(redirector, lfn):
+    return redirector.rstrip('/') + '/' + lfn
+
+
+def probe_redirector(redirector, lfn, timeout=10, nbytes=4 * 1024 * 1024):
+    '''Returns (open latency (s), read throughput (MB/s)) of `lfn` via `redirector`, or None if it fails.'''
+    from XRootD import client
+    f = client.File()
+    start = time.time()
+    status, _ = f.open(redirector_url(redirector, lfn), timeout=timeout)
+    if not status.ok:
+        return None
+    latency = time.time() - start
+    start = time.time()
+    status, data = f.read(0, nbytes, timeout=timeout)
+    f.close(timeout=timeout)
+    if not status.ok or not data:
+        return None
+    return latency, len(data) / 1024. / 1024. / max(time.time() - start, 1e-6)
+
+
+class RedirectorSelector(object):
+    '''
+    Ranks the `candidates` by the expected time to open a file and read `ref_mb` from it (from `probe`), the ones
+    that failed the probe last. `failover` moves a redirector that failed to the end of the ranking.
+    '''
+
+    def __init__(self, candidates, probe=probe_redirector, ref_mb=100., verbose=True):
+        self.ranked = list(candidates)
+        self.probe_func = probe
+        self.ref_mb = ref_mb
+        self.verbose = verbose
+        self._lock = threading.Lock()
+
+    @property
+    def best(self):
+        return self.ranked[0]
+
+    def probe(self, lfn):
+        from multiprocessing.pool import ThreadPool
+
+        def run_probe(redirector):
+            try:
+                return self.probe_func(redirector, lfn)
+            except Exception as e:
+                if self.verbose:
+                    print('[redirector] Probing %s failed: %s' % (redirector, e))
+                return None
+
+        pool = ThreadPool(len(self.ranked))
+        results = pool.map(run_probe, self.ranked)
+        pool.close()
+        pool.join()
+        cost = {}
+        for redirector, res in zip(self.ranked, results):
+            cost[redirector] = res[0] + self.ref_mb / res[1] if res and res[1] > 0 else float('inf')
+            if self.verbose:
+                print('[redirector] %s: %s' % (redirector, 'latency %.2f s, %.1f MB/s' % res if res else 'FAILED'))
+        self.ranked = sorted(self.ranked, key=lambda r: cost[r])
+        if self.verbose:
+            print('[redirector] Using %s' % self.best)
+        return self.best
+
+    def url(self, lfn):
+        return redirector_url(self.best, lfn)
+
+    def rewrite(self, url):
+        '''`url` w/ the current best redirector.'''
+        m = re.match(r'^(root://[^/]+/)/*(/store/.*)$', url)
+        return self.url(m.group(2)) if m else url
+
+    def failover(self, url):
+        '''Returns `url` w/ the next redirector (after moving the one of `url` to the end), or None.'''
+        m = re.match(r'^(root://[^/]+/)/*(/store/.*)$', url)
+        if not m or len(self.ranked) < 2:
+            return None
+        failed, lfn = m.group(1), m.group(2)
+        with self._lock:
+            matching = [r for r in self.ranked if r.rstrip('/') == failed.rstrip('/')]
+            if matching and self.ranked[0] == matching[0]:
+                self.ranked.append(self.ranked.pop(0))
+            if self.verbose:
+                print('[redirector] Read of %s failed, switching to %s' % (url, self.best))
+            return self.url(lfn) if self.best.rstrip('/') != failed.rstrip('/') else None
+
+
+def check_input(url, treename='Events'):
+    '''Raises IOError if `url` cannot be opened or the first entry of `treename` cannot be read.'''
+    import ROOT
+    f = ROOT.TFile.Open(url)
+    try:
+        if not f or f.IsZombie():
+            raise IOError('Cannot open %s' % url)
+        tree = f.Get(treename)
+        if not tree or (tree.GetEntries() > 0 and tree.GetEntry(0) <= 0):
+            raise IOError('Cannot read %s from %s' % (treename, url))
+    finally:
+        if f:
+            f.Close()
+
+
+def open_with_failover(url, selector, check=check_input):
+    '''Returns `url`, or the same file via the next redirector(s) of `selector` if it cannot be read.'''
+    if selector is not None:
+        url = selector.rewrite(url)
+    # every redirector is tried once, `failover` would otherwise cycle through them forever
+    for _ in range(len(selector.ranked) if selector is not None else 1):
+        try:
+            check(url)
+            return url
+        except Exception as e:
+            error = e
+            next_url = selector.failover(url) if selector is not None else None
+            if next_url is None:
+                break
+            url = next_url
+    raise IOError('Cannot read %s via any redirector: %s' % (url, error))
+
+
+class FailoverInputs(object):
+    '''Iterable over the (remote) `files`, each checked w/ `open_with_failover` just before it is processed.'''
+
+    def __init__(self, files, selector, check=check_input):
+        self.files = list(files)
+        self.selector = selector
+        self.check = check
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        for fname in self.files:
+            yield open_with_failover(fname, self.selector, self.check) if fname.startswith('root://') else fname
+
+
+class FilePrefetcher(object):
+    '''
+    Iterable over `files`, yielding local copies of the remote (`root://`) ones.
+
+    Up to `depth` files ahead of the one being processed are copied to `workdir`, as long as the copies on disk stay
+    within `budget_mb` (the file needed next is always copied). The copy of a file is deleted when the next one is
+    requested. Files that cannot be copied are yielded unchanged, i.e., read via xrootd. W/ a `selector`, each retry
+    of a failed copy goes through the next redirector, and so does the direct read of a file that could not be copied
+    (see `open_with_failover`).
+    '''
+
+    def __init__(self, files, workdir=None, depth=1, budget_mb=8000, max_retry=2, selector=None, verbose=True,
+                 check=check_input):
+        self.files = list(files)
+        self.selector = selector
+        self.check = check
+        self.workdir = workdir or os.path.join(os.environ.get('TMPDIR', '/tmp'), 'prefetch_%d' % os.getpid())
+        self.depth = depth
+        self.budget = budget_mb * 1024 * 1024
+        self.max_retry = max_retry
+        self.verbose = verbose
+
+    def __len__(self):
+        return len(self.files)
+
+    def _log(self, msg):
+        if self.verbose:
+            print('[prefetch] %s' % msg)
+
+    def _copy(self, fname):
+        localfile = os.path.join(self.workdir, os.path.basename(fname))
+        tmpfile = localfile + '.part'
+        if self.selector is not None:
+            # earlier failures may have changed the redirector
+            fname = self.selector.rewrite(fname)
+        for attempt in range(1 + self.max_retry):
+            start = time.time()
+            p = subprocess.Popen(['xrdcp', '-f', '-N', fname, tmpfile], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            log = p.communicate()[0]
+            if p.returncode == 0:
+                os.rename(tmpfile, localfile)
+                size = os.path.getsize(localfile)
+                self._log('Copied %s (%.1f MB) in %.1f s' % (fname, size / 1024. / 1024., time.time() - start))
+                return localfile, size, fname
+            self._log('Failed to copy %s (attempt %d): %s' % (fname, attempt + 1, log.decode('utf-8', 'replace').strip()))
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            if self.selector is not None:
+                fname = self.selector.failover(fname) or fname
+        return None, 0, fname
+
+    def _fetch_loop(self):
+        for idx, fname in enumerate(self.files):
+            with self._cond:
+                if fname.startswith('root://'):
+                    while not self._stop and idx > self._current and (
+                            idx > self._current + self.depth or self._used + self._max_size > self.budget):
+                        self._cond.wait()
+                if self._stop:
+                    return
+            localfile, size, url = None, 0, fname
+            try:
+                if fname.startswith('root://'):
+                    localfile, size, url = self._copy(fname)
+            except Exception as e:
+                # e.g., a full disk: read the file remotely instead
+                self._log('Failed to copy %s, reading it via xrootd: %s' % (fname, e))
+                localfile, size, url = None, 0, fname
+            finally:
+                # always publish the file, the iterator waits for it
+                with self._cond:
+                    self._local[idx] = localfile
+                    self._urls[idx] = url
+                    self._sizes[idx] = size
+                    self._used += size
+                    self._max_size = max(self._max_size, size)
+                    self._cond.notify_all()
+
+    def _release(self, idx):
+        # called w/ the lock held
+        localfile = self._local.get(idx)
+        if localfile and os.path.exists(localfile):
+            os.remove(localfile)
+        self._used -= self._sizes.pop(idx, 0)
+
+    def __iter__(self):
+        if not os.path.exists(self.workdir):
+            os.makedirs(self.workdir)
+        self._cond = threading.Condition()
+        self._local, self._sizes, self._urls = {}, {}, {}
+        self._current, self._used, self._max_size = 0, 0, 0
+        self._stop = False
+        thread = threading.Thread(target=self._fetch_loop)
+        thread.daemon = True
+        thread.start()
+        try:
+            for idx, fname in enumerate(self.files):
+                with self._cond:
+                    if idx > 0:
+                        self._release(idx - 1)
+                    self._current = idx
+                    self._cond.notify_all()
+                    wait_start = time.time()
+                    while idx not in self._local:
+                        self._cond.wait()
+                    localfile, url = self._local[idx], self._urls[idx]
+                if fname.startswith('root://'):
+                    self._log('File %d/%d ready after waiting %.1f s' % (idx + 1, len(self.files), time.time() - wait_start))
+                if localfile is None and self.selector is not None and url.startswith('root://'):
+                    url = open_with_failover(url, self.selector, self.check)
+                yield localfile or url
+        finally:
+            with self._cond:
+                self._stop = True
+                self._cond.notify_all()
+            thread.join()
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class StageOut(object):
+    '''
+    Copy files to `destdir` (an xrootd url) in background threads w/ `xrdcp`, verifying the adler32 checksum of the
+    destination against the source. Failed copies are retried up to `max_retry` times, after an exponential backoff
+    (`base_delay` * 2^attempt, at most `max_delay`, w/ +-50% jitter).
+    '''
+
+    def __init__(self, destdir, max_retry=3, base_delay=30, max_delay=600, verbose=True):
+        self.destdir = destdir
+        self.max_retry = max_retry
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.verbose = verbose
+        self._threads = []
+        self._results = {}
+        self._start = None
+
+    def _log(self, msg):
+        if self.verbose:
+            print('[stageout] %s' % msg)
+
+    def _copy(self, fname):
+        import random
+        dest = '%s/%s' % (self.destdir, os.path.basename(fname))
+        cmd = ['xrdcp', '--silent', '-p', '-f', '--cksum', 'adler32:source', fname, dest]
+        start = time.time()
+        for attempt in range(1 + self.max_retry):
+            if attempt > 0:
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                self._log('Retrying %s in %.0f s' % (fname, delay))
+                time.sleep(delay)
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            log = p.communicate()[0]
+            if p.returncode == 0:
+                elapsed = time.time() - start
+                self._log('Copied %s to %s in %.1f s (%d attempts)' % (fname, dest, elapsed, attempt + 1))
+                self._results[fname] = {'ok': True, 'attempts': attempt + 1, 'seconds': elapsed,
+                                        'bytes': os.path.getsize(fname)}
+                return
+            self._log('Failed to copy %s (attempt %d): %s' % (fname, attempt + 1, log.decode('utf-8', 'replace').strip()))
+        self._results[fname] = {'ok': False, 'attempts': 1 + self.max_retry, 'seconds': time.time() - start,
+                                'bytes': os.path.getsize(fname)}
+
+    def submit(self, fname):
+        '''Start copying `fname` in the background.'''
+        if self._start is None:
+            self._start = time.time()
+        thread = threading.Thread(target=self._copy, args=(fname,))
+        thread.start()
+        self._threads.append(thread)
+
+    def wait(self):
+        '''Wait for all the copies, raise RuntimeError if any failed. Returns the stage-out metrics.'''
+        for thread in self._threads:
+            thread.join()
+        failed = [f for f, r in self._results.items() if not r['ok']]
+        metrics = {'files': len(self._results),
+                   'bytes': sum(r['bytes'] for r in self._results.values()),
+                   'attempts': sum(r['attempts'] for r in self._results.values()),
+                   'seconds': time.time() - self._start if self._start is not None else 0.}
+        if failed:
+            raise RuntimeError('Stage out FAILED for %s!' % ', '.join(failed))
+        return metrics
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser('Probe the xrootd redirectors w/ a file')
+    parser.add_argument('lfn', help='LFN of the file to read, e.g., /store/mc/...')
+    parser.add_argument('-r', '--redirectors', default='',
+                        help='Comma separated list of redirectors, empty for the defaults of this host. Default: %(default)s')
+    parser.add_argument('--timeout', type=int, default=10, help='Timeout (s) of the open and of the read. Default: %(default)s')
+    args = parser.parse_args()
+
+    candidates = args.redirectors.split(',') if args.redirectors else default_redirectors()
+    selector = RedirectorSelector(candidates, probe=lambda r, lfn: probe_redirector(r, lfn, timeout=args.timeout))
+    selector.probe(args.lfn)
+    print('Ranking: %s' % ', '.join(selector.ranked))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
 from ..helpers.utils import deltaR, closest, polarP4, sumP4, get_subjets, corrected_svmass, configLogger
 from ..helpers.xgbHelper import XGBEnsemble
-from ..helpers.nnHelper import convert_prob, ensemble
+from ..helpers.nnHelper import ScoreCombiner, bb_vs_top, ensemble
 from ..helpers.jetmetCorrector import JetMETCorrector, rndSeed
 
 import logging
@@ -19,6 +19,34 @@ configLogger('nano', loglevel=logging.INFO)
 lumi_dict = {'2015': 19.52, '2016': 16.81, '2017': 41.48, '2018': 59.83, '2022preEE': 7.87, '2022postEE': 26.27, '2023preBPIX': 17.96, '2023postBPIX': 9.50}
 year_dict = {'2015': 2015, '2016': 2016, '2017': 2017, '2018': 2018, '2022preEE': 2022, '2022postEE': 2022, '2023preBPIX': 2023, '2023postBPIX': 2023}
 
+# ParticleNet-MD discriminants, as `(signal classes, background classes)`, None = the QCD classes
+_pn_md_discriminants = {'QCD': (None, None),
+                        'XbbVsQCD': (['Xbb'], None),
+                        'XccVsQCD': (['Xcc'], None),
+                        'XccOrXqqVsQCD': (['Xcc', 'Xqq'], None),
+                        'XqqVsQCD': (['Xqq'], None)}
+_pn_md_classes = ['Xbb', 'Xcc', 'Xqq', 'QCDbb', 'QCDb', 'QCDcc', 'QCDc', 'QCDothers']
+_pn_md_combiner = ScoreCombiner(['ParticleNetMD_prob' + n for n in _pn_md_classes], _pn_md_discriminants,
+                                prefix='ParticleNetMD_prob')
+_orig_pn_md_combiner = ScoreCombiner(['ParticleNetMD_prob' + n for n in _pn_md_classes],
+                                     {'XccVsQCD': (['Xcc'], None), 'XbbVsQCD': (['Xbb'], None)},
+                                     prefix='ParticleNetMD_prob')
+_deepak8_zhbb_combiner = ScoreCombiner(['deepTag_prob' + n for n in ['Zbb', 'Hbb', 'QCDbb', 'QCDb', 'QCDcc', 'QCDc', 'QCDothers']],
+                                       {'ZHbbvsQCD': (['Zbb', 'Hbb'], None)}, prefix='deepTag_prob')
+_pn_combiner = ScoreCombiner(['ParticleNet_prob' + n for n in ['Tbcq', 'Tbqq', 'Wcq', 'Wqq', 'Zbb', 'Zcc', 'Zqq',
+                                                                'QCDbb', 'QCDb', 'QCDcc', 'QCDc', 'QCDothers']],
+                             {'TvsQCD': (['Tbcq', 'Tbqq'], None),
+                              'WvsQCD': (['Wcq', 'Wqq'], None),
+                              'ZvsQCD': (['Zbb', 'Zcc', 'Zqq'], None)}, prefix='ParticleNet_prob')
+
+# GloParT V3 outputs (w/o the hidden neurons), keyed by the NanoAOD `globalParT3_` names: the class scores
+# (`prob*` in the model), the discriminants w/ the mass (`probWithMass*`) and the mass corrections
+_globalpart_scores = ['Xbb', 'Xcc', 'Xcs', 'Xqq', 'Xtauhtaue', 'Xtauhtaum', 'Xtauhtauh',
+                      'XWW4q', 'XWW3q', 'XWWqqev', 'XWWqqmv',
+                      'TopbWqq', 'TopbWq', 'TopbWev', 'TopbWmv', 'TopbWtauhv', 'QCD']
+_globalpart_withmass = ['withMassTopvsQCD', 'withMassWvsQCD', 'withMassZvsQCD']
+_globalpart_outputs = _globalpart_scores + _globalpart_withmass + ['massCorrX2p', 'massCorrGeneric']
+
 class _NullObject:
     '''An null object which does not store anything, and does not raise exception.'''
 
@@ -52,7 +80,10 @@ class HeavyFlavBaseProducer(Module, object):
         self._opts = {'sfbdt_threshold': -99,
                       'run_tagger': False, 'tagger_versions': ['V02b', 'V02c', 'V02d'],
                       'run_mass_regression': False, 'mass_regression_versions': ['V01a', 'V01b', 'V01c'],
-                      'WRITE_CACHE_FILE': False}
+                      'tagger_precision': 'fp32', 'mass_regression_precision': 'fp32',
+                      'ensemble_threads': None, 'onnx_session_options': {},
+                      'run_globalpart': False, 'globalpart_hidden_neurons': False, 'globalpart_batch_size': 256,
+                      'globalpart_min_pt': 150, 'WRITE_CACHE_FILE': False}
         for k in kwargs:
             if k in self._jmeSysts:
                 self._jmeSysts[k] = kwargs[k]
@@ -100,22 +131,47 @@ class HeavyFlavBaseProducer(Module, object):
             self.fatjetCorr = JetMETCorrector(year=self.year, jetType="AK8PFPuppi", **self._jmeSysts)
             self.subjetCorr = JetMETCorrector(year=self.year, jetType="AK4PFPuppi", **self._jmeSysts)
 
+        if self._opts['run_tagger'] or self._opts['run_mass_regression'] or self._opts['run_globalpart']:
+            from ..helpers.makeInputs import EventsReader
+            self.uprootReader = EventsReader(fetch_step=1000)
+
         if self._opts['run_tagger'] or self._opts['run_mass_regression']:
             from ..helpers.makeInputs import ParticleNetTagInfoMaker
-            from ..helpers.runPrediction import ParticleNetJetTagsProducer
+            from ..helpers.runPrediction import ParticleNetJetTagsProducer, ParticleNetEnsemble
             self.tagInfoMaker = ParticleNetTagInfoMaker(
                 fatjet_branch=self._fj_name, pfcand_branch='PFCands', sv_branch='SV', jetR=self._jetConeSize)
             prefix = os.path.expandvars('$CMSSW_BASE/src/PhysicsTools/NanoHRTTools/data')
             if self._opts['run_tagger']:
-                self.pnTaggers = [ParticleNetJetTagsProducer(
+                self.pnTaggers = ParticleNetEnsemble([ParticleNetJetTagsProducer(
                     '%s/ParticleNet-MD/%s/{version}/particle-net.onnx' % (prefix, self.jetType),
                     '%s/ParticleNet-MD/%s/{version}/preprocess.json' % (prefix, self.jetType),
-                    version=ver, cache_suffix='tagger') for ver in self._opts['tagger_versions']]
+                    version=ver, cache_suffix='tagger', session_options=self._opts['onnx_session_options'],
+                    precision=self._opts['tagger_precision'])
+                    for ver in self._opts['tagger_versions']],
+                    nthreads=self._opts['ensemble_threads'])
+                self._pnTaggerCombiner = ScoreCombiner(self.pnTaggers.output_names, _pn_md_discriminants, prefix='prob')
             if self._opts['run_mass_regression']:
-                self.pnMassRegressions = [ParticleNetJetTagsProducer(
+                self.pnMassRegressions = ParticleNetEnsemble([ParticleNetJetTagsProducer(
                     '%s/MassRegression/%s/{version}/particle_net_regression.onnx' % (prefix, self.jetType),
                     '%s/MassRegression/%s/{version}/preprocess.json' % (prefix, self.jetType),
-                    version=ver, cache_suffix='mass') for ver in self._opts['mass_regression_versions']]
+                    version=ver, cache_suffix='mass', session_options=self._opts['onnx_session_options'],
+                    precision=self._opts['mass_regression_precision'])
+                    for ver in self._opts['mass_regression_versions']],
+                    nthreads=self._opts['ensemble_threads'])
+
+        if self._opts['run_globalpart']:
+            from ..helpers.makeInputs import GlobalParTTagInfoMaker
+            from ..helpers.runPrediction import BatchedJetTagsProducer
+            self.globalParTInfoMaker = GlobalParTTagInfoMaker(
+                fatjet_branch=self._fj_name, pfcand_branch='PFCands', sv_branch='SV', jetR=self._jetConeSize)
+            prefix = os.path.expandvars('$CMSSW_BASE/src/PhysicsTools/NanoHRTTools/data')
+            if not os.path.exists('%s/GloParTV3/model.onnx' % prefix):
+                raise IOError('GloParT V3 model not found at %s/GloParTV3/model.onnx, see data/GloParTV3/README.md' % prefix)
+            self.globalParT = BatchedJetTagsProducer(
+                '%s/GloParTV3/model.onnx' % prefix, '%s/GloParTV3/preprocess.json' % prefix,
+                version='', cache_suffix='globalpart', session_options=self._opts['onnx_session_options'],
+                batch_size=self._opts['globalpart_batch_size'], eval_flags=self._globalpart_eval_flags)
+            self._globalpart_hidden_names = [n for n in self.globalParT.output_names if n.startswith('hidNeuron')]
 
         # https://twiki.cern.ch/twiki/bin/viewauth/CMS/BtagRecommendation
         self.DeepJet_WP_L = {'2015': 0.0508, '2016': 0.0480, '2017': 0.0532, '2018': 0.0490, '2022preEE': 0.0583, '2022postEE': 0.0614, '2023preBPIX': 0.0479, '2023postBPIX': 0.048}[self.year]
@@ -130,9 +186,16 @@ class HeavyFlavBaseProducer(Module, object):
         if self._opts['sfbdt_threshold'] > -99:
             self.xgb = XGBEnsemble(self._sfbdt_files, self._sfbdt_vars)
 
+    def endJob(self):
+        for name in ('pnTaggers', 'pnMassRegressions'):
+            if hasattr(self, name):
+                getattr(self, name).close()
+
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.isMC = bool(inputTree.GetBranch('genWeight'))
         self.hasParticleNetProb = bool(inputTree.GetBranch(self._fj_name + '_ParticleNetMD_probXbb'))
+        self.hasGlobalParT = {name: bool(inputTree.GetBranch(self._fj_name + '_globalParT3_' + name))
+                              for name in _globalpart_outputs}
 
         # remove all possible h5 cache files
         for f in os.listdir('.'):
@@ -140,15 +203,20 @@ class HeavyFlavBaseProducer(Module, object):
                 os.remove(f)
 
         if self._opts['run_tagger']:
-            for p in self.pnTaggers:
-                p.load_cache(inputFile)
+            self.pnTaggers.load_cache(inputFile)
 
         if self._opts['run_mass_regression']:
-            for p in self.pnMassRegressions:
-                p.load_cache(inputFile)
+            self.pnMassRegressions.load_cache(inputFile)
 
+        # the tag-info makers share one reader, so the PFCands/SV baskets are read once per window
         if self._opts['run_tagger'] or self._opts['run_mass_regression']:
-            self.tagInfoMaker.init_file(inputFile, fetch_step=1000)
+            self.tagInfoMaker.init_file(inputFile, reader=self.uprootReader)
+
+        if self._opts['run_globalpart']:
+            self.globalParTInfoMaker.init_file(inputFile, reader=self.uprootReader)
+            self.globalParT.init_file()
+            # entries passing the preselection cut, None if there is no cut
+            self._entrylist = inputTree._entrylist
 
         self.out = wrappedOutputTree
 
@@ -247,24 +315,16 @@ class HeavyFlavBaseProducer(Module, object):
             self.out.branch(prefix + "ParticleNet_massCorr", "F")
             self.out.branch(prefix + "ParticleNet_mass", "F")
 
-            self.out.branch(prefix + "GlobalParT3_Xbb", "F")
-            self.out.branch(prefix + "GlobalParT3_Xcc", "F")
-            self.out.branch(prefix + "GlobalParT3_Xcs", "F")
-            self.out.branch(prefix + "GlobalParT3_Xqq", "F")
-            self.out.branch(prefix + "GlobalParT3_Xtauhtaue", "F")
-            self.out.branch(prefix + "GlobalParT3_Xtauhtaum", "F")
-            self.out.branch(prefix + "GlobalParT3_Xtauhtauh", "F")
-            self.out.branch(prefix + "GlobalParT3_TopbWqq", "F")
-            self.out.branch(prefix + "GlobalParT3_TopbWq", "F")
-            self.out.branch(prefix + "GlobalParT3_TopbWev", "F")
-            self.out.branch(prefix + "GlobalParT3_TopbWmv", "F")
-            self.out.branch(prefix + "GlobalParT3_TopbWtauhv", "F")
-            self.out.branch(prefix + "GlobalParT3_QCD", "F")
+            for name in _globalpart_scores + _globalpart_withmass:
+                self.out.branch(prefix + "GlobalParT3_" + name, "F")
             self.out.branch(prefix + "GlobalParT3_massCorr", "F")
             self.out.branch(prefix + "GlobalParT3_massCorrGen", "F")
             self.out.branch(prefix + "GlobalParT3_mass", "F")
             self.out.branch(prefix + "GlobalParT3_massGen", "F")
-            
+            if self._opts['run_globalpart'] and self._opts['globalpart_hidden_neurons']:
+                for name in self._globalpart_hidden_names:
+                    self.out.branch(prefix + "GlobalParT3_" + name, "F")
+
             # Additional tagger scores from NanoAODv9
             self.out.branch(prefix + "DeepAK8MD_HbbvsQCD", "F")
             self.out.branch(prefix + "DeepAK8MD_H4qvsQCD", "F")
@@ -389,12 +449,10 @@ class HeavyFlavBaseProducer(Module, object):
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         if self._opts['run_tagger'] and self._opts['WRITE_CACHE_FILE']:
-            for p in self.pnTaggers:
-                p.update_cache()
+            self.pnTaggers.update_cache()
 
         if self._opts['run_mass_regression'] and self._opts['WRITE_CACHE_FILE']:
-            for p in self.pnMassRegressions:
-                p.update_cache()
+            self.pnMassRegressions.update_cache()
 
         # remove all h5 cache files
         if self._opts['run_tagger'] or self._opts['run_mass_regression']:
@@ -671,65 +729,92 @@ class HeavyFlavBaseProducer(Module, object):
                                 fj.ngpart50 += 1; fj.gpart50_sumpt += gp.pt
 
 
+    def _combine_scores(self, objs, combiner):
+        # evaluate the discriminants of `combiner` for all objs at once, None if the scores are not available
+        if len(objs) == 0:
+            return None
+        try:
+            scores = [[getattr(o, c) for c in combiner.columns] for o in objs]
+        except RuntimeError:
+            return None
+        return combiner(scores)
+
     def evalTagger(self, event, jets):
-        for j in jets:
+        if self._opts['run_tagger'] or self.hasParticleNetProb:
             if self._opts['run_tagger']:
-                outputs = [p.predict_with_cache(self.tagInfoMaker, event.idx, j.idx, j) for p in self.pnTaggers]
-                outputs = ensemble(outputs, np.mean)
-                j.pn_Xbb = outputs['probXbb']
-                j.pn_Xcc = outputs['probXcc']
-                j.pn_Xqq = outputs['probXqq']
-                j.pn_QCD = convert_prob(outputs, None, prefix='prob')
+                scores = np.array([np.mean(self.pnTaggers.predict_with_cache(self.tagInfoMaker, event.idx, j.idx, j), axis=0)
+                                   for j in jets])
+                disc = self._pnTaggerCombiner(scores) if len(jets) else None
+                probs = {name: scores[:, self._pnTaggerCombiner.columns.index('prob' + name)] if len(jets) else []
+                         for name in ('Xbb', 'Xcc', 'Xqq')}
+            else:  # nano AOD version before v12
+                disc = self._combine_scores(jets, _pn_md_combiner)
+                probs = {name: [getattr(j, 'ParticleNetMD_prob' + name) for j in jets] for name in ('Xbb', 'Xcc', 'Xqq')}
+            for idx, j in enumerate(jets):
+                j.pn_Xbb = probs['Xbb'][idx]
+                j.pn_Xcc = probs['Xcc'][idx]
+                j.pn_Xqq = probs['Xqq'][idx]
+                j.pn_QCD = disc['QCD'][idx]
                 j.pn_QCD0HF = 0.
                 j.pn_QCD1HF = 0.
                 j.pn_QCD2HF = 0.
-                j.pn_XbbVsQCD = convert_prob(j, ['Xbb'], ['QCD'], prefix='pn_')
-                j.pn_XccVsQCD = convert_prob(j, ['Xcc'], ['QCD'], prefix='pn_')
-                j.pn_XccOrXqqVsQCD = convert_prob(j, ['Xcc', 'Xqq'], ['QCD'], prefix='pn_')
-                j.pn_XqqVsQCD = convert_prob(j, ['Xqq'], ['QCD'], prefix='pn_')
+                j.pn_XbbVsQCD = disc['XbbVsQCD'][idx]
+                j.pn_XccVsQCD = disc['XccVsQCD'][idx]
+                j.pn_XccOrXqqVsQCD = disc['XccOrXqqVsQCD'][idx]
+                j.pn_XqqVsQCD = disc['XqqVsQCD'][idx]
                 j.pn_XggVsQCD = 0.
                 j.pn_XttVsQCD = 0.
                 j.pn_XtmVsQCD = 0.
                 j.pn_XteVsQCD = 0.
-            else:
-                if self.hasParticleNetProb: ## nano AOD version before v12
-                    j.pn_Xbb = j.ParticleNetMD_probXbb
-                    j.pn_Xcc = j.ParticleNetMD_probXcc
-                    j.pn_Xqq = j.ParticleNetMD_probXqq
-                    j.pn_QCD = convert_prob(j, None, prefix='ParticleNetMD_prob')
-                    j.pn_QCD0HF = 0.
-                    j.pn_QCD1HF = 0.
-                    j.pn_QCD2HF = 0.
-                    j.pn_XbbVsQCD = convert_prob(j, ['Xbb'], ['QCD'], prefix='pn_')
-                    j.pn_XccVsQCD = convert_prob(j, ['Xcc'], ['QCD'], prefix='pn_')
-                    j.pn_XccOrXqqVsQCD = convert_prob(j, ['Xcc', 'Xqq'], ['QCD'], prefix='pn_')
-                    j.pn_XqqVsQCD = convert_prob(j, ['Xqq'], ['QCD'], prefix='pn_')
-                    j.pn_XggVsQCD = 0.
-                    j.pn_XttVsQCD = 0.
-                    j.pn_XtmVsQCD = 0.
-                    j.pn_XteVsQCD = 0.
-                else: ## for nanoAOD v12 or higher
-                    j.pn_Xbb = 0
-                    j.pn_Xcc = 0
-                    j.pn_Xqq = 0
-                    j.pn_QCD = j.particleNet_QCD
-                    j.pn_QCD0HF = j.particleNet_QCD0HF
-                    j.pn_QCD1HF = j.particleNet_QCD1HF
-                    j.pn_QCD2HF = j.particleNet_QCD2HF
-                    j.pn_XbbVsQCD = j.particleNet_XbbVsQCD
-                    j.pn_XccVsQCD = j.particleNet_XccVsQCD
-                    j.pn_XccOrXqqVsQCD = j.particleNet_XccVsQCD + j.particleNet_XqqVsQCD
-                    j.pn_XqqVsQCD = j.particleNet_XqqVsQCD
-                    j.pn_XggVsQCD = j.particleNet_XggVsQCD
-                    j.pn_XttVsQCD = j.particleNet_XttVsQCD
-                    j.pn_XtmVsQCD = j.particleNet_XtmVsQCD
-                    j.pn_XteVsQCD = j.particleNet_XteVsQCD
+        else:  # for nanoAOD v12 or higher
+            for j in jets:
+                j.pn_Xbb = 0
+                j.pn_Xcc = 0
+                j.pn_Xqq = 0
+                j.pn_QCD = j.particleNet_QCD
+                j.pn_QCD0HF = j.particleNet_QCD0HF
+                j.pn_QCD1HF = j.particleNet_QCD1HF
+                j.pn_QCD2HF = j.particleNet_QCD2HF
+                j.pn_XbbVsQCD = j.particleNet_XbbVsQCD
+                j.pn_XccVsQCD = j.particleNet_XccVsQCD
+                j.pn_XccOrXqqVsQCD = j.particleNet_XccVsQCD + j.particleNet_XqqVsQCD
+                j.pn_XqqVsQCD = j.particleNet_XqqVsQCD
+                j.pn_XggVsQCD = j.particleNet_XggVsQCD
+                j.pn_XttVsQCD = j.particleNet_XttVsQCD
+                j.pn_XtmVsQCD = j.particleNet_XtmVsQCD
+                j.pn_XteVsQCD = j.particleNet_XteVsQCD
+        if self._opts['run_globalpart']:
+            self.evalGlobalParT(event, jets)
+
+    def _globalpart_eval_flags(self, taginfo, start):
+        '''
+        Jets of a fetch window batched for GloParT: the ones that can become probe jets, i.e., in events passing the
+        preselection cut and w/ the kinematics of `event.fatjets` (w/ a margin on the pt for the JEC variations).
+        '''
+        jetp4 = taginfo['_jetp4']
+        flags = (jetp4.pt > self._opts['globalpart_min_pt']) & (np.abs(jetp4.eta) < 2.4)
+        if self._entrylist is not None:
+            passed = np.array([bool(self._entrylist.Contains(entry)) for entry in range(start, start + len(jetp4))])
+            flags = flags & passed
+        return flags
+
+    def evalGlobalParT(self, event, jets):
+        # GloParT V3 scores and mass corrections from the inference, keyed by the NanoAOD `globalParT3_` names
+        for j in jets:
+            preds = self.globalParT.predict_batched(self.globalParTInfoMaker, event.idx, j.idx)
+            outputs = dict(zip(self.globalParT.output_names, preds))
+            j.gpt = {name: outputs['prob' + name] for name in _globalpart_scores}
+            j.gpt.update({name: outputs['prob' + name[0].upper() + name[1:]] for name in _globalpart_withmass})
+            j.gpt['massCorrX2p'] = outputs['massCorrX2p']
+            j.gpt['massCorrGeneric'] = outputs['massCorrGeneric']
+            if self._opts['globalpart_hidden_neurons']:
+                j.gpt.update({name: outputs[name] for name in self._globalpart_hidden_names})
 
     def evalMassRegression(self, event, jets):
         for j in jets:
             if self._opts['run_mass_regression']:
-                outputs = [p.predict_with_cache(self.tagInfoMaker, event.idx, j.idx, j) for p in self.pnMassRegressions]
-                j.regressed_mass = ensemble(outputs, np.median)['mass']
+                outputs = self.pnMassRegressions.predict_with_cache(self.tagInfoMaker, event.idx, j.idx, j)
+                j.regressed_mass = ensemble(outputs, np.median, self.pnMassRegressions.output_names)['mass']
             else:
                 try:
                     j.regressed_mass = j.particleNet_mass
@@ -796,6 +881,12 @@ class HeavyFlavBaseProducer(Module, object):
         return filler
 
     def fillFatJetInfo(self, event, fatjets):
+        # discriminants from the raw class scores, for the (up to two) probe jets at once
+        probe_jets = fatjets[:2]
+        deepak8_disc = self._combine_scores(probe_jets, _deepak8_zhbb_combiner)
+        pn_disc = self._combine_scores(probe_jets, _pn_combiner) if self.hasParticleNetProb else None
+        orig_pn_md_disc = self._combine_scores(probe_jets, _orig_pn_md_combiner) if self._opts['run_tagger'] else None
+
         for idx in ([1, 2] if self._channel in ['qcd', 'mutagged'] else [1]):
             prefix = 'fj_%d_' % idx
 
@@ -852,11 +943,8 @@ class HeavyFlavBaseProducer(Module, object):
                 self.out.fillBranch(prefix + "DeepAK8MD_ZHbbvsQCD", fj.deepTagMD_ZHbbvsQCD)
                 self.out.fillBranch(prefix + "DeepAK8MD_ZHccvsQCD", fj.deepTagMD_ZHccvsQCD)
                 self.out.fillBranch(prefix + "DeepAK8MD_bbVsLight", fj.deepTagMD_bbvsLight)
-                try:
-                    bbVsTop = (1 / (1 + (fj.deepTagMD_TvsQCD / fj.deepTagMD_HbbvsQCD) * (1 - fj.deepTagMD_HbbvsQCD) / (1 - fj.deepTagMD_TvsQCD)))  # noqa
-                except ZeroDivisionError:
-                    bbVsTop = 0
-                self.out.fillBranch(prefix + "DeepAK8MD_bbVsTop", bbVsTop)
+                self.out.fillBranch(prefix + "DeepAK8MD_bbVsTop",
+                                    float(bb_vs_top(fj.deepTagMD_HbbvsQCD, fj.deepTagMD_TvsQCD)))
             except RuntimeError:
                 # if no DeepAK8 branches
                 self.out.fillBranch(prefix + "DeepAK8_TvsQCD", -1)
@@ -870,21 +958,14 @@ class HeavyFlavBaseProducer(Module, object):
                 self.out.fillBranch(prefix + "DeepAK8MD_bbVsLight", -1)
                 self.out.fillBranch(prefix + "DeepAK8MD_bbVsTop", -1)
 
-            try:
-                self.out.fillBranch(prefix + "DeepAK8_ZHbbvsQCD",
-                                    convert_prob(fj, ['Zbb', 'Hbb'], prefix='deepTag_prob'))
-            except RuntimeError:
-                # if no DeepAK8 raw probs
-                self.out.fillBranch(prefix + "DeepAK8_ZHbbvsQCD", -1)
+            # -1 if no DeepAK8 raw probs
+            self.out.fillBranch(prefix + "DeepAK8_ZHbbvsQCD",
+                                deepak8_disc['ZHbbvsQCD'][idx - 1] if deepak8_disc else -1)
 
             # ParticleNet
             if self.hasParticleNetProb:
-                self.out.fillBranch(prefix + "ParticleNet_TvsQCD",
-                                    convert_prob(fj, ['Tbcq', 'Tbqq'], prefix='ParticleNet_prob'))
-                self.out.fillBranch(prefix + "ParticleNet_WvsQCD",
-                                    convert_prob(fj, ['Wcq', 'Wqq'], prefix='ParticleNet_prob'))
-                self.out.fillBranch(prefix + "ParticleNet_ZvsQCD",
-                                    convert_prob(fj, ['Zbb', 'Zcc', 'Zqq'], prefix='ParticleNet_prob'))
+                for name in ('TvsQCD', 'WvsQCD', 'ZvsQCD'):
+                    self.out.fillBranch(prefix + "ParticleNet_" + name, pn_disc[name][idx - 1] if pn_disc else -1)
             else:
                 try:
                     # nominal ParticleNet from official NanoAOD
@@ -915,10 +996,9 @@ class HeavyFlavBaseProducer(Module, object):
             self.out.fillBranch(prefix + "ParticleNetMD_XteVsQCD", fj.pn_XteVsQCD)
 
             if self._opts['run_tagger']:
-                self.out.fillBranch(prefix + "origParticleNetMD_XccVsQCD",
-                                    convert_prob(fj, ['Xcc'], None, prefix='ParticleNetMD_prob'))
-                self.out.fillBranch(prefix + "origParticleNetMD_XbbVsQCD",
-                                    convert_prob(fj, ['Xbb'], None, prefix='ParticleNetMD_prob'))
+                for name in ('XccVsQCD', 'XbbVsQCD'):
+                    self.out.fillBranch(prefix + "origParticleNetMD_" + name,
+                                        orig_pn_md_disc[name][idx - 1] if orig_pn_md_disc else -1)
 
             # Additional tagger scores from NanoAODv9
             try:
@@ -946,71 +1026,19 @@ class HeavyFlavBaseProducer(Module, object):
             except RuntimeError:
                 self.out.fillBranch(prefix + "ParticleNet_massCorr", -1)
 
-            ## GloParT V3            
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_Xbb", fj.globalParT3_Xbb)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_Xbb", -1)                
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_Xcc", fj.globalParT3_Xcc)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_Xcc", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_Xcs", fj.globalParT3_Xcs)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_Xcs", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_Xqq", fj.globalParT3_Xqq)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_Xqq", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_Xtauhtaue", fj.globalParT3_Xtauhtaue)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_Xtauhtaue", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_Xtauhtaum", fj.globalParT3_Xtauhtaum)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_Xtauhtaum", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_Xtauhtauh", fj.globalParT3_Xtauhtauh)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_Xtauhtauh", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWqq", fj.globalParT3_TopbWqq)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWqq", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWq", fj.globalParT3_TopbWq)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWq", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWev", fj.globalParT3_TopbWev)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWev", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWmv", fj.globalParT3_TopbWmv)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWmv", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWtauhv", fj.globalParT3_TopbWtauhv)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_TopbWtauhv", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_QCD", fj.globalParT3_QCD)
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_QCD", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_massCorr", fj.globalParT3_massCorrX2p)
-                self.out.fillBranch(prefix + "GlobalParT3_mass", fj.globalParT3_massCorrX2p*fj.mass*(1.-fj.rawFactor))                
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_massCorr", -1)
-                self.out.fillBranch(prefix + "GlobalParT3_mass", -1)
-            try:
-                self.out.fillBranch(prefix + "GlobalParT3_massCorrGen", fj.globalParT3_massCorrGeneric)
-                self.out.fillBranch(prefix + "GlobalParT3_massGen", fj.globalParT3_massCorrGeneric*fj.mass*(1.-fj.rawFactor))
-            except RuntimeError:
-                self.out.fillBranch(prefix + "GlobalParT3_massGen", -1)
-                self.out.fillBranch(prefix + "GlobalParT3_massCorrGen", -1)
+            ## GloParT V3: from the inference, or read from NanoAOD (-1 if not in the input)
+            gpt = fj.gpt if self._opts['run_globalpart'] else {
+                name: getattr(fj, 'globalParT3_' + name) if has else -1 for name, has in self.hasGlobalParT.items()}
+            for name in _globalpart_scores + _globalpart_withmass:
+                self.out.fillBranch(prefix + "GlobalParT3_" + name, gpt[name])
+            for name, corr in (('', 'massCorrX2p'), ('Gen', 'massCorrGeneric')):
+                massCorr = gpt[corr]
+                self.out.fillBranch(prefix + "GlobalParT3_massCorr" + name, massCorr)
+                self.out.fillBranch(prefix + "GlobalParT3_mass" + name,
+                                    massCorr * fj.mass * (1. - fj.rawFactor) if massCorr != -1 else -1)
+            if self._opts['run_globalpart'] and self._opts['globalpart_hidden_neurons']:
+                for name in self._globalpart_hidden_names:
+                    self.out.fillBranch(prefix + "GlobalParT3_" + name, gpt[name])
 
             try:
                 self.out.fillBranch(prefix + "btagDDBvLV2", fj.btagDDBvLV2)
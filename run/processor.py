@@ -3,18 +3,18 @@ from __future__ import print_function
 
 import os
 import sys
-import time
 import json
 import argparse
-import subprocess
 from importlib import import_module
 from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import PostProcessor
+from PhysicsTools.NanoHRTTools.helpers.sumwHelper import file_sumw, write_sumw
+from PhysicsTools.NanoHRTTools.helpers.mergeHelper import merge_files
 
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 
-def xrd_prefix(filepaths):
+def xrd_prefix(filepaths, selector=None, prefetch_eos=False):
     prefix = ''
     allow_prefetch = False
     if not isinstance(filepaths, (list, tuple)):
@@ -22,18 +22,24 @@ def xrd_prefix(filepaths):
     filepath = filepaths[0]
     if filepath.startswith('/eos/cms'):
         prefix = 'root://eoscms.cern.ch/'
+        allow_prefetch = prefetch_eos
     elif filepath.startswith('/eos/user'):
         prefix = 'root://eosuser.cern.ch/'
+        allow_prefetch = prefetch_eos
     elif filepath.startswith('/eos/uscms'):
         prefix = 'root://cmseos.fnal.gov/'
+        allow_prefetch = prefetch_eos
     elif filepath.startswith('/store/'):
         # remote file
-        import socket
-        host = socket.getfqdn()
-        if 'cern.ch' in host:
-            prefix = 'root://xrootd-cms.infn.it//'
+        if selector is not None:
+            prefix = selector.best.rstrip('/') + '//'
         else:
-            prefix = 'root://cmsxrootd.fnal.gov//'
+            import socket
+            host = socket.getfqdn()
+            if 'cern.ch' in host:
+                prefix = 'root://xrootd-cms.infn.it//'
+            else:
+                prefix = 'root://cmsxrootd.fnal.gov//'
         allow_prefetch = True
     expanded_paths = [(prefix + '/' + f if prefix else f) for f in filepaths]
     return expanded_paths, allow_prefetch
@@ -44,11 +50,36 @@ def outputName(md, jobid):
     return '{samp}_{idx}_tree.root'.format(samp=info['samp'], idx=info['idx'])
 
 
+def sumwName(md, jobid):
+    info = md['jobs'][jobid]
+    return '{samp}_{idx}_sumw.json'.format(samp=info['samp'], idx=info['idx'])
+
+
+def clear_meta_trees(fname, treenames=('Runs', 'LuminosityBlocks')):
+    '''
+    Keep empty `Runs`/`LuminosityBlocks` trees in the output of a job processing an entry range of a file (other
+    than the first one), so the per-file content (e.g., the sum of weights) is counted once after merging.
+    '''
+    f = ROOT.TFile.Open(fname, 'UPDATE')
+    for name in treenames:
+        tree = f.Get(name)
+        if tree:
+            tree.CloneTree(0).Write(name, ROOT.TObject.kOverwrite)
+    f.Close()
+
+
 def main(args):
 
     # load job metadata
-    with open(args.metadata) as fp:
-        md = json.load(fp)
+    if args.metadata.endswith('.json'):
+        with open(args.metadata) as fp:
+            md = json.load(fp)
+    else:
+        # only the options and the row of this job
+        from PhysicsTools.NanoHRTTools.helpers.metadataHelper import MetadataStore
+        store = MetadataStore(args.metadata, readonly=True)
+        md = store.job_metadata(args.jobid)
+        store.close()
 
     # load modules
     modules = []
@@ -70,73 +101,106 @@ def main(args):
             os.remove(f)
 
     # run postprocessor
-    inputfiles = args.files if len(args.files) else md['jobs'][args.jobid]['inputfiles']
-    filepaths, allow_prefetch = xrd_prefix(inputfiles)
+    jobinfo = {} if len(args.files) else md['jobs'][args.jobid]
+    inputfiles = args.files if len(args.files) else jobinfo['inputfiles']
+    selector = None
+    if inputfiles[0].startswith('/store/'):
+        # pick the redirector w/ the first file, the prefetcher fails over to the next ones on copy errors
+        from PhysicsTools.NanoHRTTools.helpers.xrootdHelper import RedirectorSelector, default_redirectors
+        redirectors = md.get('redirectors')
+        selector = RedirectorSelector(redirectors.split(',') if redirectors else default_redirectors())
+        selector.probe(inputfiles[0])
+    # EOS inputs are staged too if the tag-info makers read them a second time w/ uproot
+    filepaths, allow_prefetch = xrd_prefix(inputfiles, selector, prefetch_eos=md.get('prefetch_eos', False))
     print(filepaths)
+    # remote inputs are copied in the background while the previous file is processed,
+    # unless the PostProcessor's long-term cache is used
+    prefetch = allow_prefetch and not md.get('no_prefetch', False)
+    if prefetch and not md.get('longTermCache', False):
+        from PhysicsTools.NanoHRTTools.helpers.xrootdHelper import FilePrefetcher
+        filepaths = FilePrefetcher(filepaths, depth=md.get('prefetch_depth', 1), budget_mb=md.get('prefetch_budget', 8000),
+                                   selector=selector)
+        prefetch = False
+    elif selector is not None:
+        # read via xrootd: each file is checked before it is processed, and read via the next redirector on errors
+        from PhysicsTools.NanoHRTTools.helpers.xrootdHelper import FailoverInputs
+        filepaths = FailoverInputs(filepaths, selector)
     outputname = outputName(md, args.jobid)
     p = PostProcessor(outputDir='.',
                       inputFiles=filepaths,
                       cut=md.get('cut'),
                       branchsel=os.path.basename(md['branchsel_in']),
                       modules=modules,
-                      compression=md.get('compression', 'LZMA:9'),
+                      compression=md.get('compression', 'LZ4:4'),
                       friend=md.get('friend', False),
                       postfix=md.get('postfix'),
                       jsonInput=md.get('json'),
                       provenance=md.get('provenance', False),
                       haddFileName=None,
-                      prefetch=(allow_prefetch and md.get('prefetch', False)),
+                      prefetch=prefetch,
                       longTermCache=md.get('longTermCache', False),
-                      maxEntries=md.get('maxEntries', None),
-                      firstEntry=md.get('firstEntry', 0),
+                      maxEntries=jobinfo.get('maxEntries', md.get('maxEntries', None)),
+                      firstEntry=jobinfo.get('firstEntry', md.get('firstEntry', 0)),
                       outputbranchsel=os.path.basename(md['branchsel_out'])
                       )
     p.run()
 
-    # hadd files
-    p = subprocess.Popen('haddnano.py %s *.root' % outputname, shell=True)
-    p.communicate()
-    if p.returncode != 0:
-        raise RuntimeError('Hadd failed!')
+    # hadd files: a single output is just renamed, several ones are merged w/o recompression when their content matches
+    outputs = sorted(f for f in os.listdir('.') if f.endswith('.root') and f != outputname)
+    if len(outputs) == 1:
+        os.rename(outputs[0], outputname)
+        print('Renamed output %s to %s' % (outputs[0], outputname))
+    else:
+        entries = merge_files(outputname, outputs)
+        print('Merged %d outputs into %s: %s' % (len(outputs), outputname, entries))
 
     # keep only the hadd file
     for f in os.listdir('.'):
         if f.endswith('.root') and f != outputname:
             os.remove(f)
 
-    # stage out
+    if jobinfo.get('firstEntry', 0) > 0:
+        clear_meta_trees(outputname)
+
+    # the output is complete: start staging it out while the sums of weights are computed
+    stageout = None
     if md['outputdir'].startswith('/eos'):
-        cmd = 'xrdcp --silent -p -f {outputname} {outputdir}/{outputname}'.format(
-            outputname=outputname, outputdir=xrd_prefix(md['joboutputdir'])[0][0])
-        print(cmd)
-        success = False
-        for count in range(args.max_retry):
-            p = subprocess.Popen(cmd, shell=True)
-            p.communicate()
-            if p.returncode == 0:
-                success = True
-                break
-            else:
-                time.sleep(args.sleep)
-        if not success:
-            raise RuntimeError("Stage out FAILED!")
+        from PhysicsTools.NanoHRTTools.helpers.xrootdHelper import StageOut
+        stageout = StageOut(xrd_prefix(md['joboutputdir'])[0][0], max_retry=args.max_retry, base_delay=args.sleep)
+        stageout.submit(outputname)
+
+    # sums of weights of the job, so that `--add-weight` does not need to read the merged file
+    outputfiles = [outputname]
+    sumw = file_sumw(outputname)
+    if sumw is not None:
+        write_sumw(sumw, sumwName(md, args.jobid))
+        outputfiles.append(sumwName(md, args.jobid))
+        if stageout is not None:
+            stageout.submit(sumwName(md, args.jobid))
+
+    if stageout is not None:
+        metrics = stageout.wait()
+        # harvested from the job stdout by `runPostProcessing.py`
+        print('JOB_METRICS %s' % json.dumps({'stageout_seconds': metrics['seconds'],
+                                             'stageout_mb': metrics['bytes'] / 1024. / 1024.,
+                                             'stageout_attempts': metrics['attempts']}))
 
         # clean up
-        os.remove(outputname)
-
+        for fname in outputfiles:
+            os.remove(fname)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='NanoAOD postprocessing.')
     parser.add_argument('-m', '--metadata',
-                        default='metadata.json',
-                        help='Path to the metadata file. Default:%(default)s')
+                        default='metadata.db',
+                        help='Path to the metadata file (SQLite store, or json). Default:%(default)s')
     parser.add_argument('--max-retry',
                         type=int, default=3,
                         help='Max number of retry for stageout. Default: %(default)s'
                         )
     parser.add_argument('--sleep',
-                        type=int, default=120,
-                        help='Seconds to wait before retry stageout. Default: %(default)s'
+                        type=int, default=30,
+                        help='Base delay (s) of the exponential backoff between stageout retries. Default: %(default)s'
                         )
     parser.add_argument('--files',
                         nargs='*', default=[],
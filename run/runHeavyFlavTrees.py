@@ -15,6 +15,18 @@ default_config = {'sfbdt_threshold': -99,
                   'tagger_versions': ['V02b', 'V02c', 'V02d'],
                   'run_mass_regression': False,
                   'mass_regression_versions': ['V01a', 'V01b', 'V01c'],
+                  'tagger_precision': 'fp32',
+                  'mass_regression_precision': 'fp32',
+                  'run_globalpart': False,
+                  'globalpart_hidden_neurons': False,
+                  'globalpart_batch_size': 256,
+                  'globalpart_min_pt': 150,
+                  'ensemble_threads': None,  # None: one thread per model version, 1: run them sequentially
+                  'onnx_session_options': {'intra_op_num_threads': 1,
+                                           'inter_op_num_threads': 1,
+                                           'graph_optimization_level': 'all',
+                                           'execution_mode': 'sequential',
+                                           'cache_optimized_model': True},
                   'jec': True,
                   'jes': None,
                   'jes_source': '',
@@ -44,6 +56,11 @@ cut_dict_ak15 = {
     'inclusive': 'Sum$((Jet_pt>25 && abs(Jet_eta)<2.4 && (Jet_jetId & 2)) * Jet_pt)>300 && Sum$(AK15Puppi_subJetIdx1>=0 && AK15Puppi_subJetIdx2>=0 && AK15Puppi_msoftdrop>10)>0',
 }
 
+mass_regression_versions = {
+    'ak8': ['ak8V01a', 'ak8V01b', 'ak8V01c'],
+    'ak15': ['V01a', 'V01b', 'V01c'],
+}
+
 golden_json = {
     '2015': 'Cert_271036-284044_13TeV_Legacy2016_Collisions16_JSON.txt',
     '2016': 'Cert_271036-284044_13TeV_Legacy2016_Collisions16_JSON.txt',
@@ -56,6 +73,24 @@ golden_json = {
 }
 
 
+def _cache_optimized_models(args):
+    '''Write the optimized ONNX graphs into the CMSSW area before it is tarred, so the jobs load them directly.'''
+    from PhysicsTools.NanoHRTTools.helpers.runPrediction import load_model
+    datadir = os.path.expandvars('$CMSSW_BASE/src/PhysicsTools/NanoHRTTools/data')
+    model_files = []
+    if args.run_tagger:
+        model_files += [(os.path.join(datadir, 'ParticleNet-MD', args.jet_type, ver, 'particle-net.onnx'),
+                         default_config['tagger_precision']) for ver in default_config['tagger_versions']]
+    if args.run_mass_regression:
+        model_files += [(os.path.join(datadir, 'MassRegression', args.jet_type, ver, 'particle_net_regression.onnx'),
+                         default_config['mass_regression_precision']) for ver in mass_regression_versions[args.jet_type]]
+    if args.run_globalpart:
+        model_files.append((os.path.join(datadir, 'GloParTV3', 'model.onnx'), 'fp32'))
+    for model_file, precision in model_files:
+        if os.path.exists(model_file):
+            load_model(model_file, default_config['onnx_session_options'], precision)
+
+
 def _process(args):
     default_config['jetType'] = args.jet_type
     if args.run_tagger:
@@ -65,9 +100,22 @@ def _process(args):
         logging.info('Will run tagger version(s): %s' % ','.join(default_config['tagger_versions']))
     if args.run_mass_regression:
         default_config['run_mass_regression'] = True
-        if args.jet_type == 'ak8':
-            default_config['mass_regression_versions'] = ['ak8V01a', 'ak8V01b', 'ak8V01c']
+        default_config['mass_regression_versions'] = mass_regression_versions[args.jet_type]
         logging.info('Will run mass regression version(s): %s' % ','.join(default_config['mass_regression_versions']))
+    if args.run_globalpart:
+        model_file = os.path.expandvars('$CMSSW_BASE/src/PhysicsTools/NanoHRTTools/data/GloParTV3/model.onnx')
+        if not os.path.exists(model_file):
+            raise IOError('`--run-globalpart` needs the GloParT V3 model at %s, see data/GloParTV3/README.md' % model_file)
+        default_config['run_globalpart'] = True
+        default_config['globalpart_hidden_neurons'] = args.globalpart_hidden_neurons
+        logging.info('Will run GloParT V3 inference%s' % (' with hidden neurons' if args.globalpart_hidden_neurons else ''))
+
+    if args.run_tagger or args.run_mass_regression or args.run_globalpart:
+        # the tag-info makers read PFCands/SV again with uproot, which is remote I/O w/o the local copies
+        if args.no_prefetch:
+            logging.warning('On-the-fly inference w/ `--no-prefetch`: PFCands/SV will be read again via xrootd')
+        else:
+            args.prefetch_eos = True
 
     year = args.year
     channel = args.channel
@@ -221,9 +269,21 @@ def main():
                         help='Run mass regression. Default: %(default)s'
                         )
 
+    parser.add_argument('--run-globalpart',
+                        action='store_true', default=False,
+                        help='Run GloParT V3 inference instead of reading the `globalParT3_*` NanoAOD branches. Default: %(default)s'
+                        )
+
+    parser.add_argument('--globalpart-hidden-neurons',
+                        action='store_true', default=False,
+                        help='Also store the GloParT V3 hidden-neuron outputs (requires `--run-globalpart`). Default: %(default)s'
+                        )
+
     args = parser.parse_args()
 
     if not (args.post or args.add_weight or args.merge):
+        if args.run_tagger or args.run_mass_regression or args.run_globalpart:
+            _cache_optimized_models(args)
         tar_cmssw(args.tarball_suffix)
 
     years = args.year.split(',')
@@ -237,6 +297,8 @@ def main():
                 if cat == 'data':
                     opts.run_data = True
                     opts.nfiles_per_job *= 2
+                    opts.events_per_job *= 2
+                    opts.size_per_job *= 2
                 if opts.inputdir:
                     opts.inputdir = opts.inputdir.rstrip('/').replace('_YEAR_', year)
                     assert(year in opts.inputdir)
@@ -6,6 +6,7 @@ import os
 import sys
 import json
 import re
+import time
 import shutil
 import tempfile
 
@@ -32,14 +33,24 @@ def sname(sample_or_dataset_name):
         return sample_or_dataset_name
 
 
-def get_filenames(dataset, retry=3):
-    """Return files for given DAS query via dasgoclient"""
+def _file_records(files):
+    # file records are dicts w/ `name` and, if known, `nevents` and `size`
+    return [rec if isinstance(rec, dict) else {'name': rec} for rec in files]
+
+
+def _query_das(dataset, das_client='dasgoclient', retry=3):
+    """Return file records for given DAS query via `das_client`: a dasgoclient-compatible command, or a json file
+    w/ the dataset -> files (or file records) mapping (e.g., to run offline)"""
     import subprocess
-    import time
+    if das_client.endswith('.json'):
+        with open(das_client) as f:
+            files = _file_records(json.load(f)[dataset])
+        logging.info('Found %d files for %s in %s' % (len(files), dataset, das_client))
+        return files
     query = 'file dataset=%s' % dataset
     if dataset.endswith('/USER'):
         query += ' instance=prod/phys03'
-    cmd = ['dasgoclient', '-query', query, '-json']
+    cmd = das_client.split() + ['-query', query, '-json']
     retry_count = 0
     while True:
         logging.info('Querying DAS:\n  %s' % ' '.join(cmd) + '' if retry_count == 0 else '\n... retry %d ...' % retry_count)
@@ -59,71 +70,194 @@ def get_filenames(dataset, retry=3):
                 for rec in row.get('file', []):
                     fname = rec.get('name', '')
                     if fname:
-                        files.append(str(fname))
+                        files.append({'name': str(fname), 'nevents': rec.get('nevents'), 'size': rec.get('size')})
             logging.info('Found %d files for %s' % (len(files), dataset))
             return files
 
 
-def add_weight_branch(file, xsec, lumi=1000., treename='Events', wgtbranch='xsecWeight'):
-    from array import array
+def get_filenames(dataset, retry=3, das_client='dasgoclient', cache_dir=None, cache_ttl=0):
+    """Return files for given dataset"""
+    return [rec['name'] for rec in get_file_records(dataset, retry, das_client, cache_dir, cache_ttl)]
+
+
+def get_file_records(dataset, retry=3, das_client='dasgoclient', cache_dir=None, cache_ttl=0):
+    """Return file records for given dataset, from the cache in `cache_dir` if not older than `cache_ttl` hours"""
+    if not cache_dir or cache_ttl <= 0:
+        return _query_das(dataset, das_client, retry)
+    cache_file = os.path.join(cache_dir, dataset.strip('/').replace('/', '__') + '.json')
+    if os.path.exists(cache_file) and time.time() - os.path.getmtime(cache_file) < cache_ttl * 3600:
+        with open(cache_file) as f:
+            files = _file_records(json.load(f))
+        logging.debug('Loaded %d files for %s from cache %s' % (len(files), dataset, cache_file))
+        return files
+    files = _query_das(dataset, das_client, retry)
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass  # created concurrently
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(files, f)
+    os.rename(tmp_file, cache_file)
+    return files
+
+
+def get_entries(filepaths, cache_dir=None):
+    """Return the number of entries of the `Events` tree of local files, w/ an index cached in `cache_dir`"""
     import ROOT
     ROOT.PyConfig.IgnoreCommandLineOptions = True
+    index = {}
+    index_file = os.path.join(cache_dir, 'entries.json') if cache_dir else None
+    if index_file and os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+    entries = []
+    updated = False
+    for fpath in filepaths:
+        key = os.path.abspath(fpath)
+        st = os.stat(fpath)
+        if key not in index or index[key][:2] != [st.st_size, st.st_mtime]:
+            f = ROOT.TFile.Open(fpath)
+            index[key] = [st.st_size, st.st_mtime, int(f.Get('Events').GetEntries())]
+            f.Close()
+            updated = True
+        entries.append(index[key][2])
+    if index_file and updated:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_file = '%s.%d.tmp' % (index_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp_file, index_file)
+    return entries
+
+
+def split_files(files, fileinfo, nfiles_per_job, events_per_job=0, bytes_per_job=0):
+    """
+    Group `files` into jobs (dicts w/ `inputfiles`). W/o a budget, `nfiles_per_job` files per job. Otherwise the
+    files are packed, in order, up to `events_per_job` events or `bytes_per_job` bytes per job, and a file above
+    the budget is split into entry ranges (`firstEntry`/`maxEntries`), one job per range.
+    """
+    import math
+    key = 'nevents' if events_per_job else 'size'
+    budget = events_per_job or bytes_per_job
+    if budget and any(fileinfo.get(f, {}).get(key) is None for f in files):
+        logging.warning('Missing %s for some of the files, will split by number of files' % key)
+        budget = 0
+    if not budget:
+        for chunk in get_chunks(files, nfiles_per_job):
+            yield {'inputfiles': chunk}
+        return
 
-    def _get_sum(tree, wgtvar):
-        htmp = ROOT.TH1D('htmp', 'htmp', 1, 0, 10)
-        tree.Project('htmp', '1.0', wgtvar)
-        return float(htmp.Integral())
+    chunk, chunk_weight = [], 0
+    for f in files:
+        weight = fileinfo[f][key]
+        nevents = fileinfo[f].get('nevents')
+        if weight > budget and nevents:
+            nsplit = int(math.ceil(float(weight) / budget))
+            step = int(math.ceil(float(nevents) / nsplit))
+            for first in range(0, nevents, step):
+                yield {'inputfiles': [f], 'firstEntry': first, 'maxEntries': step}
+            continue
+        if chunk and chunk_weight + weight > budget:
+            yield {'inputfiles': chunk}
+            chunk, chunk_weight = [], 0
+        chunk.append(f)
+        chunk_weight += weight
+    if chunk:
+        yield {'inputfiles': chunk}
+
+
+_const_branch_filler = '''
+#include <algorithm>
+#include <stdexcept>
+#include <string>
+#include <vector>
+#include "TBranch.h"
+#include "TTree.h"
+
+namespace nanohrt {
+// add a branch w/ the same value(s) for all entries, w/o going through python for each entry
+void fillConstBranch(TTree *tree, const std::string &name, const std::vector<float> &values, const std::string &lenVar) {
+  std::vector<float> buff(values);
+  UInt_t len = 0;
+  TBranch *bLen = nullptr;
+  TBranch *b = nullptr;
+  if (lenVar.empty()) {
+    b = tree->Branch(name.c_str(), buff.data(), (name + "/F").c_str());
+  } else {
+    b = tree->Branch(name.c_str(), buff.data(), (name + "[" + lenVar + "]/F").c_str());
+    bLen = tree->GetBranch(lenVar.c_str());
+    bLen->SetAddress(&len);
+  }
+  // constant values compress to almost nothing, a few large baskets are enough
+  Long64_t nbytes = tree->GetEntries() * (Long64_t)(sizeof(float) * buff.size() + 8);
+  b->SetBasketSize((Int_t)std::min<Long64_t>(std::max<Long64_t>(nbytes, 32000), 16000000));
+  for (Long64_t i = 0; i < tree->GetEntries(); ++i) {
+    if (bLen) {
+      bLen->GetEntry(i);
+      if (len > buff.size()) {
+        throw std::runtime_error("Entry " + std::to_string(i) + " has more elements in " + lenVar + " than values for " + name);
+      }
+    }
+    b->Fill();
+  }
+  b->ResetAddress();
+  if (bLen) {
+    bLen->ResetAddress();
+  }
+}
+}
+'''
+
+
+def add_weight_branch(file, xsec, lumi=1000., treename='Events', wgtbranch='xsecWeight', sumw=None):
+    '''`sumw`: sums of weights of the sample (see `sumwHelper`), read from the `Runs` tree of the file if not given.'''
+    import ROOT
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    from PhysicsTools.NanoHRTTools.helpers.sumwHelper import runs_sumw
+    if not hasattr(ROOT, 'nanohrt'):
+        ROOT.gInterpreter.Declare(_const_branch_filler)
 
     def _fill_const_branch(tree, branch_name, buff, lenVar=None):
-        if lenVar is not None:
-            b = tree.Branch(branch_name, buff, '%s[%s]/F' % (branch_name, lenVar))
-            b_lenVar = tree.GetBranch(lenVar)
-            buff_lenVar = array('I', [0])
-            b_lenVar.SetAddress(buff_lenVar)
-        else:
-            b = tree.Branch(branch_name, buff, branch_name + '/F')
-
-        b.SetBasketSize(tree.GetEntries() * 2)  # be sure we do not trigger flushing
-        for i in range(tree.GetEntries()):
-            if lenVar is not None:
-                b_lenVar.GetEntry(i)
-            b.Fill()
-
-        b.ResetAddress()
-        if lenVar is not None:
-            b_lenVar.ResetAddress()
-
-    filetmp = os.path.join(tempfile.mkdtemp(), file.split('/')[-1])
-    import shutil
-    shutil.move(file, filetmp)
+        values = ROOT.std.vector('float')()
+        for v in buff:
+            values.push_back(v)
+        ROOT.nanohrt.fillConstBranch(tree, branch_name, values, lenVar or '')
+
+    # only files on EOS are updated on a local copy: UPDATE over the fuse mount is not reliable
+    filetmp = file
+    if os.path.abspath(file).startswith('/eos'):
+        filetmp = os.path.join(tempfile.mkdtemp(), file.split('/')[-1])
+        shutil.move(file, filetmp)
     f = ROOT.TFile(filetmp, 'UPDATE')
-    run_tree = f.Get('Runs')
     tree = f.Get(treename)
+    if sumw is None:
+        # one pass over the Runs tree for all the sums
+        sumw = runs_sumw(f.Get('Runs'))
 
     # fill cross section weights to the 'Events' tree
-    sumwgts = _get_sum(run_tree, 'genEventSumw')
+    sumwgts = sumw['genEventSumw']
     xsecwgt = xsec * lumi / sumwgts
-    xsec_buff = array('f', [xsecwgt])
-    _fill_const_branch(tree, wgtbranch, xsec_buff)
+    _fill_const_branch(tree, wgtbranch, [xsecwgt])
 
     # fill LHE weight re-normalization factors
     if tree.GetBranch('LHEScaleWeight'):
-        run_tree.GetEntry(0)
-        nScaleWeights = run_tree.nLHEScaleSumw
-        scale_weight_norm_buff = array('f', [sumwgts / _get_sum(run_tree, 'LHEScaleSumw[%d]*genEventSumw' % i) for i in range(nScaleWeights)])
+        scale_weight_norm_buff = [sumwgts / s for s in sumw['LHEScaleSumw']]
         logging.info('LHEScaleWeightNorm: ' + str(scale_weight_norm_buff))
         _fill_const_branch(tree, 'LHEScaleWeightNorm', scale_weight_norm_buff, lenVar='nLHEScaleWeight')
 
     if tree.GetBranch('LHEPdfWeight'):
-        run_tree.GetEntry(0)
-        nPdfWeights = run_tree.nLHEPdfSumw
-        pdf_weight_norm_buff = array('f', [sumwgts / _get_sum(run_tree, 'LHEPdfSumw[%d]*genEventSumw' % i) for i in range(nPdfWeights)])
+        pdf_weight_norm_buff = [sumwgts / s for s in sumw['LHEPdfSumw']]
         logging.info('LHEPdfWeightNorm: ' + str(pdf_weight_norm_buff))
         _fill_const_branch(tree, 'LHEPdfWeightNorm', pdf_weight_norm_buff, lenVar='nLHEPdfWeight')
 
+    # only the tree header is rewritten, the baskets of the existing branches are left untouched
     tree.Write(treename, ROOT.TObject.kOverwrite)
     f.Close()
-    shutil.move(filetmp, file)
+    if filetmp != file:
+        shutil.move(filetmp, file)
 
 
 def load_dataset_file(dataset_file):
@@ -186,30 +320,113 @@ def parse_sample_xsec(cfgfile):
     return xsec_dict
 
 
+_tarball_excludes = ['/.git/', '/tmp/', '/jobs.*/', '/logs/', ]
+# the tarball is the concatenation of one tar.gz per layer, so only the layers that changed are rebuilt
+_tarball_layers = [('external', ['external']), ('lib', ['biglib', 'lib', 'bin', 'objs']), ('src', None)]
+_tarball_checked = {}
+
+
+def _tarball_layer_files(cmsswdir, topdirs):
+    '''(arcname, path) of the entries of a layer: `topdirs` of the CMSSW area, or all the other ones if None.'''
+    base = os.path.basename(cmsswdir)
+    others = set(d for _, dirs in _tarball_layers if dirs for d in dirs)
+    entries = []
+    if topdirs is None:
+        entries.append((base, cmsswdir))
+    for top in sorted(os.listdir(cmsswdir)):
+        if (top in topdirs) if topdirs is not None else (top not in others):
+            if os.path.islink(os.path.join(cmsswdir, top)) or not os.path.isdir(os.path.join(cmsswdir, top)):
+                entries.append((base + '/' + top, os.path.join(cmsswdir, top)))
+                continue
+            for root, dirnames, filenames in os.walk(os.path.join(cmsswdir, top)):
+                arcroot = base + '/' + os.path.relpath(root, cmsswdir)
+                if any(re.search(pattern, arcroot + '/') for pattern in _tarball_excludes):
+                    dirnames[:] = []
+                    continue
+                entries.append((arcroot, root))
+                for name in sorted(dirnames) + sorted(filenames):
+                    path = os.path.join(root, name)
+                    if name in dirnames and not os.path.islink(path):
+                        continue  # added by the walk
+                    entries.append((arcroot + '/' + name, path))
+                dirnames.sort()
+    return entries
+
+
+def _tarball_layer_hash(entries, chunk_size=1024 * 1024):
+    '''sha1 of the path and the content of each entry (the target of symlinks), regular files read in chunks.'''
+    import hashlib
+    h = hashlib.sha1()
+    for arcname, path in entries:
+        h.update(('%s\n' % arcname).encode('utf-8'))
+        if os.path.islink(path):
+            h.update(('-> %s\n' % os.readlink(path)).encode('utf-8'))
+        elif os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    h.update(chunk)
+    return h.hexdigest()[:16]
+
+
 def tar_cmssw(tarball_suffix, batchMode=False):
+    '''
+    Create the CMSSW tarball, keyed by the hash of the files included: an existing tarball w/ the same hash is reused
+    as is, otherwise only the layers (see `_tarball_layers`) that changed are rebuilt. The layers are concatenated
+    gzip'ed tar files, extracted w/ `tar -xzif`.
+    '''
+    import tarfile
     cmsswdir = os.environ['CMSSW_BASE']
     cmsswtar = os.path.abspath(os.path.expandvars('$CMSSW_BASE/../CMSSW%s.tar.gz' % tarball_suffix))
+    if _tarball_checked.get(cmsswtar):
+        return
+    hashfile = cmsswtar + '.hash'
+    layerdir = os.path.join(os.path.dirname(cmsswtar), '.CMSSW%s_layers' % tarball_suffix)
+
+    layers = []
+    for name, topdirs in _tarball_layers:
+        entries = _tarball_layer_files(cmsswdir, topdirs)
+        layers.append((name, entries, _tarball_layer_hash(entries)))
+    tarball_hash = ','.join('%s-%s' % (name, h) for name, _, h in layers)
+
     if os.path.exists(cmsswtar):
+        old_hash = open(hashfile).read().strip() if os.path.exists(hashfile) else None
+        if old_hash == tarball_hash:
+            logging.info('Reusing CMSSW tarball %s (%s)' % (cmsswtar, tarball_hash))
+            _tarball_checked[cmsswtar] = True
+            return
         if batchMode:
+            logging.warning('CMSSW tarball %s is outdated, but will not be replaced in batch mode' % cmsswtar)
             return
-        ans = input('CMSSW tarball %s already exists, remove? [yn] ' % cmsswtar)
-        if ans.lower()[0] == 'y':
-            os.remove(cmsswtar)
-        else:
+        ans = input('CMSSW tarball %s is outdated, rebuild? [yn] ' % cmsswtar)
+        if ans.lower()[0] != 'y':
             return
 
-    def exclude(tarinfo):
-        exclude_patterns = ['/.git/', '/tmp/', '/jobs.*/', '/logs/', ]
-        for pattern in exclude_patterns:
-            if re.search(pattern, tarinfo.name):
-                logging.debug('ignoring %s in the tarball', tarinfo.name)
-                tarinfo = None
-                break
-        return tarinfo
-
-    import tarfile
-    with tarfile.open(cmsswtar, "w:gz") as tar:
-        tar.add(cmsswdir, arcname=os.path.basename(cmsswdir), filter=exclude)
+    if not os.path.exists(layerdir):
+        os.makedirs(layerdir)
+    layerfiles = []
+    for name, entries, h in layers:
+        layerfile = os.path.join(layerdir, '%s-%s.tar.gz' % (name, h))
+        if not os.path.exists(layerfile):
+            logging.info('Creating layer %s of the CMSSW tarball w/ %d entries' % (name, len(entries)))
+            with tarfile.open(layerfile + '.tmp', 'w:gz') as tar:
+                for arcname, path in entries:
+                    tar.add(path, arcname=arcname, recursive=False)
+            os.rename(layerfile + '.tmp', layerfile)
+        layerfiles.append(layerfile)
+    # drop the outdated layers
+    for f in os.listdir(layerdir):
+        if os.path.join(layerdir, f) not in layerfiles:
+            os.remove(os.path.join(layerdir, f))
+
+    with open(cmsswtar + '.tmp', 'wb') as fout:
+        for layerfile in layerfiles:
+            with open(layerfile, 'rb') as fin:
+                shutil.copyfileobj(fin, fout)
+    os.rename(cmsswtar + '.tmp', cmsswtar)
+    with open(hashfile, 'w') as f:
+        f.write(tarball_hash + '\n')
+    _tarball_checked[cmsswtar] = True
+    logging.info('Created CMSSW tarball %s (%s)' % (cmsswtar, tarball_hash))
 
 
 def create_metadata(args):
@@ -221,7 +438,7 @@ def create_metadata(args):
         - 'samples': (list)
         - 'inputfiles': (dict, sample -> files)
         - 'jobs': (list of dict)
-            - jobitem: (dict, keys: 'samp', 'idx', 'inputfiles')
+            - jobitem: (dict, keys: 'samp', 'idx', 'inputfiles', and optionally 'firstEntry', 'maxEntries', 'nevents')
     '''
 
     arg_blacklist = ['metadata', 'select', 'ignore', 'site', 'datasets']
@@ -236,6 +453,8 @@ def create_metadata(args):
     md['samples'] = []
     md['inputfiles'] = {}
     md['jobs'] = []
+    fileinfo = {}  # file -> {'nevents', 'size'}, for the event/size based splitting
+    bytes_per_job = int(args.size_per_job * 1024 * 1024)
 
     def select_sample(dataset):
         samp = sname(dataset)
@@ -293,10 +512,19 @@ def create_metadata(args):
                 filelist = sorted(filelist)
                 md['samples'].append(samp)
                 md['inputfiles'][samp] = filelist
+                for fpath in filelist:
+                    fileinfo[fpath] = {'size': os.path.getsize(fpath)}
+                # only read the file headers when needed, i.e., to balance by events or to split large files
+                need_entries = [fpath for fpath in filelist if args.events_per_job or
+                                (bytes_per_job and fileinfo[fpath]['size'] > bytes_per_job)]
+                if need_entries:
+                    cache_dir = os.path.expanduser(args.das_cache_dir) if args.das_cache_ttl > 0 else None
+                    for fpath, nevents in zip(need_entries, get_entries(need_entries, cache_dir)):
+                        fileinfo[fpath]['nevents'] = nevents
     else:
         # use remote files
+        datasets = []
         for samp in samp_to_datasets:
-            filelist = []
             dataset0 = None
             for dataset in samp_to_datasets[samp]:
                 if dataset0 is None:
@@ -304,8 +532,26 @@ def create_metadata(args):
                 else:
                     if dataset0 != dataset.split('/')[1]:
                         raise RuntimeError('Inconsistent dataset for samp `%s`: `%s` vs `%s`' % (samp, dataset0, dataset))
-                if select_sample(dataset):
-                    filelist.extend(get_filenames(dataset))
+                if select_sample(dataset) and dataset not in datasets:
+                    datasets.append(dataset)
+
+        # query the datasets concurrently
+        from multiprocessing.pool import ThreadPool
+        import functools
+        pool = ThreadPool(max(1, min(args.das_workers, len(datasets))))
+        dataset_files = dict(zip(datasets, pool.map(
+            functools.partial(get_file_records, das_client=args.das_client,
+                              cache_dir=os.path.expanduser(args.das_cache_dir), cache_ttl=args.das_cache_ttl),
+            datasets)))
+        pool.close()
+
+        for samp in samp_to_datasets:
+            filelist = []
+            for dataset in samp_to_datasets[samp]:
+                if dataset in dataset_files:
+                    for rec in dataset_files[dataset]:
+                        filelist.append(rec['name'])
+                        fileinfo[rec['name']] = rec
             if len(filelist):
                 filelist = sorted(filelist)
                 md['samples'].append(samp)
@@ -314,58 +560,137 @@ def create_metadata(args):
     # sort the samples
     md['samples'] = natural_sort(md['samples'])
 
+    profile = load_job_profile(args) if args.target_walltime > 0 else {}
+
     # discover the files
     for samp in md['samples']:
         # sort the input list
         md['inputfiles'][samp] = natural_sort(md['inputfiles'][samp])
 
+        # re-split samples w/ a runtime profile to fit the target walltime
+        nfiles_per_job, events_per_job, samp_bytes_per_job = args.nfiles_per_job, args.events_per_job, bytes_per_job
+        prof = profile.get(samp, {})
+        target = args.target_walltime * 3600
+        if prof.get('sec_per_event') and all(fileinfo.get(f, {}).get('nevents') for f in md['inputfiles'][samp]):
+            events_per_job, samp_bytes_per_job = max(1, int(target / prof['sec_per_event'])), 0
+            logging.info('Splitting %s w/ %d events per job from the job profile' % (samp, events_per_job))
+        elif prof.get('sec_per_file'):
+            nfiles_per_job, events_per_job, samp_bytes_per_job = max(1, int(target / prof['sec_per_file'])), 0, 0
+            logging.info('Splitting %s w/ %d files per job from the job profile' % (samp, nfiles_per_job))
+
         # create jobs
-        for idx, chunk in enumerate(get_chunks(md['inputfiles'][samp], args.nfiles_per_job)):
-            md['jobs'].append({'samp': samp, 'idx': idx, 'inputfiles': chunk})
+        for idx, job in enumerate(split_files(md['inputfiles'][samp], fileinfo, nfiles_per_job,
+                                              events_per_job, samp_bytes_per_job)):
+            job.update({'samp': samp, 'idx': idx})
+            nevents = [fileinfo.get(f, {}).get('nevents') for f in job['inputfiles']]
+            if None not in nevents:
+                job['nevents'] = min(job['maxEntries'], nevents[0] - job['firstEntry']) if 'maxEntries' in job else sum(nevents)
+            md['jobs'].append(job)
 
     return md
 
 
-def load_metadata(args):
+def metadata_file(args):
+    '''Path of the metadata store, `-m metadata.json` (jobdirs created w/ older versions) maps to `metadata.db`.'''
     metadatafile = os.path.join(args.jobdir, args.metadata)
-    with open(metadatafile) as f:
-        md = json.load(f)
-    return md
+    if metadatafile.endswith('.json'):
+        metadatafile = os.path.splitext(metadatafile)[0] + '.db'
+    return metadatafile
+
+
+def legacy_metadata_file(args):
+    '''Path of the json metadata of jobdirs created w/ older versions, whatever `-m` says.'''
+    return os.path.splitext(metadata_file(args))[0] + '.json'
+
+
+def metadata_store(args, readonly=True):
+    from PhysicsTools.NanoHRTTools.helpers.metadataHelper import MetadataStore
+    metadatafile = metadata_file(args)
+    jsonfile = legacy_metadata_file(args)
+    if not os.path.exists(metadatafile) and os.path.exists(jsonfile):
+        logging.info('Converting %s to %s' % (jsonfile, metadatafile))
+        with open(jsonfile) as f:
+            MetadataStore.create(metadatafile, json.load(f)).close()
+    return MetadataStore(metadatafile, readonly=readonly)
+
+
+def status_store(args):
+    '''Store of the job status and metrics, kept apart from the metadata store that is transferred to the jobs.'''
+    from PhysicsTools.NanoHRTTools.helpers.metadataHelper import JobStatusStore
+    return JobStatusStore(os.path.join(args.jobdir, 'status.db'))
+
+
+def _parse_log(chunk, state):
+    '''
+    Update the job `state` (dict w/ `finished` and `errormsg`) w/ the lines appended to the condor log.
+    Only the lines after the last submission count, same as reading the log backwards from the end.
+    '''
+    for line in chunk.splitlines():
+        if 'Job submitted from host' in line:
+            # the job has been (re)submitted
+            state['finished'] = False
+            state['errormsg'] = None
+        elif 'return value' in line:
+            if 'return value 0' in line:
+                state['finished'] = True
+                state['errormsg'] = None
+            else:
+                state['finished'] = False
+                state['errormsg'] = line
+        elif 'Job removed' in line or 'aborted' in line:
+            state['errormsg'] = line
+    return state
 
 
 def check_job_status(args):
-    md = load_metadata(args)
-    njobs = len(md['jobs'])
+    '''
+    The parsed state of each log is kept in the status store, together w/ the offset read so far,
+    so repeated checks only read the bytes appended to the logs since the previous check.
+    '''
+    store = metadata_store(args)
+    njobs = store.njobs()
+    store.close()
+    store = status_store(args)
+    index = store.status()
+    changed, removed = {}, []
     jobids = {'running': [], 'failed': [], 'completed': []}
     for jobid in range(njobs):
         logpath = os.path.join(args.jobdir, '%d.log' % jobid)
-        if not os.path.exists(logpath):
+        try:
+            st = os.stat(logpath)
+        except OSError:
             logging.debug('Cannot find log file %s' % logpath)
             jobids['failed'].append(str(jobid))
+            if index.pop(jobid, None) is not None:
+                removed.append(jobid)
             continue
-        with open(logpath) as logfile:
-            errormsg = None
-            finished = False
-            for line in reversed(logfile.readlines()):
-                if 'Job removed' in line or 'aborted' in line:
-                    errormsg = line
-                if 'Job submitted from host' in line:
-                    # if seeing this first: the job has been resubmited
-                    break
-                if 'return value' in line:
-                    if 'return value 0' in line:
-                        finished = True
-                    else:
-                        errormsg = line
-                    break
-            if errormsg:
-                logging.debug(logpath + '\n   ' + errormsg)
-                jobids['failed'].append(str(jobid))
+        entry = index.get(jobid)
+        if entry is None or entry['inode'] != st.st_ino or st.st_size < entry['offset']:
+            # new, replaced or truncated log: parse from the beginning
+            entry = {'inode': st.st_ino, 'offset': 0, 'finished': False, 'errormsg': None}
+            index[jobid] = entry
+            changed[jobid] = entry
+        if st.st_size > entry['offset']:
+            with open(logpath, 'rb') as logfile:
+                logfile.seek(entry['offset'])
+                chunk = logfile.read(st.st_size - entry['offset'])
+            # only consume complete lines, the job may be writing the last one
+            end = chunk.rfind(b'\n') + 1
+            if end > 0:
+                _parse_log(chunk[:end].decode('utf-8', 'replace'), entry)
+                entry['offset'] += end
+                changed[jobid] = entry
+        if entry['errormsg']:
+            logging.debug(logpath + '\n   ' + entry['errormsg'])
+            jobids['failed'].append(str(jobid))
+        else:
+            if entry['finished']:
+                jobids['completed'].append(str(jobid))
             else:
-                if finished:
-                    jobids['completed'].append(str(jobid))
-                else:
-                    jobids['running'].append(str(jobid))
+                jobids['running'].append(str(jobid))
+    if changed or removed:
+        store.update_status(changed, removed)
+    store.close()
     assert sum(len(jobids[k]) for k in jobids) == njobs
     all_completed = len(jobids['completed']) == njobs
     info = {k: len(jobids[k]) for k in jobids if len(jobids[k])}
@@ -373,12 +698,200 @@ def check_job_status(args):
     return all_completed, jobids
 
 
+def _log_time(line):
+    # event time of a condor log line, e.g., `005 (123.000.000) 2024-01-31 12:00:00 Job terminated.`
+    import datetime
+    m = re.match(r'^\d{3} \([\d.]+\) (\S+ \S+)', line)
+    if m:
+        for fmt in ('%Y-%m-%d %H:%M:%S', '%m/%d %H:%M:%S'):
+            try:
+                return datetime.datetime.strptime(m.group(1), fmt)
+            except ValueError:
+                pass
+    return None
+
+
+def parse_job_metrics(logpath, outpath=None):
+    '''
+    Peak memory usage (MB) over all the executions of a job, and the runtime (s) and return value of the last one,
+    from its condor log, plus the `JOB_METRICS` (e.g., stage-out time) printed by `processor.py` in its stdout.
+    '''
+    metrics = {'memory_mb': None, 'runtime': None, 'returncode': None}
+    start = None
+    with open(logpath) as logfile:
+        for line in logfile:
+            memory = None
+            if line.startswith('001 '):
+                # Job executing
+                start = _log_time(line)
+                metrics['runtime'] = None
+                metrics['returncode'] = None
+            elif line.startswith('005 '):
+                # Job terminated
+                end = _log_time(line)
+                if start and end and end > start:
+                    metrics['runtime'] = (end - start).total_seconds()
+            elif 'return value' in line:
+                metrics['returncode'] = int(re.search(r'return value (-?\d+)', line).group(1))
+            elif 'MemoryUsage of job (MB)' in line:
+                memory = int(line.split()[0])
+            elif line.strip().startswith('Memory (MB)'):
+                memory = int(line.split(':')[1].split()[0])
+            if memory is not None:
+                metrics['memory_mb'] = max(memory, metrics['memory_mb'] or 0)
+    if outpath and os.path.exists(outpath):
+        with open(outpath) as outfile:
+            for line in outfile:
+                if line.startswith('JOB_METRICS '):
+                    try:
+                        metrics.update(json.loads(line[len('JOB_METRICS '):]))
+                    except ValueError:
+                        pass
+    return metrics
+
+
+def load_job_profile(args):
+    if not args.job_profile or not os.path.exists(args.job_profile):
+        return {}
+    with open(args.job_profile) as f:
+        return json.load(f)
+
+
+def update_job_profile(args):
+    '''
+    Harvest the peak memory and the runtime of the jobs in the jobdir into the per-sample profile `--job-profile`:
+    the max memory usage, and the 90% quantiles of the runtime per input event and per input file.
+    The metrics of each job are kept in the status store as well.
+    '''
+    if not args.job_profile or not (os.path.exists(metadata_file(args)) or os.path.exists(legacy_metadata_file(args))):
+        return
+    store = metadata_store(args)
+    jobs = store.jobs()
+    store.close()
+    store = status_store(args)
+    cached = store.metrics()
+    updated = {}
+    harvested = {}
+    for jobid, job in enumerate(jobs):
+        logpath = os.path.join(args.jobdir, '%d.log' % jobid)
+        try:
+            st = os.stat(logpath)
+        except OSError:
+            continue
+        metrics = cached.get(jobid)
+        if metrics is None or metrics['log_inode'] != st.st_ino or metrics['log_size'] != st.st_size:
+            # only the logs changed since the last harvest are parsed again
+            metrics = parse_job_metrics(logpath, os.path.join(args.jobdir, '%d.out' % jobid))
+            metrics.update(log_inode=st.st_ino, log_size=st.st_size)
+            updated[jobid] = metrics
+        h = harvested.setdefault(job['samp'], {'memory_mb': [], 'sec_per_event': [], 'sec_per_file': []})
+        if metrics['memory_mb']:
+            h['memory_mb'].append(metrics['memory_mb'])
+        if metrics['returncode'] == 0 and metrics['runtime']:
+            if job.get('nevents'):
+                h['sec_per_event'].append(metrics['runtime'] / job['nevents'])
+            if 'firstEntry' not in job:
+                h['sec_per_file'].append(metrics['runtime'] / len(job['inputfiles']))
+    if updated:
+        store.update_metrics(updated)
+    store.close()
+
+    def q90(values):
+        return sorted(values)[int(0.9 * (len(values) - 1))] if values else None
+
+    profile = load_job_profile(args)
+    for samp, h in harvested.items():
+        entry = profile.setdefault(samp, {})
+        if h['memory_mb']:
+            entry['memory_mb'] = max(h['memory_mb'])
+        for k in ('sec_per_event', 'sec_per_file'):
+            if h[k]:
+                entry[k] = q90(h[k])
+        entry['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    tmp_file = '%s.%d.tmp' % (args.job_profile, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    os.rename(tmp_file, args.job_profile)
+    logging.info('Updated job profile %s w/ %d samples from %s' % (args.job_profile, len(harvested), args.jobdir))
+
+
+def job_resources(args, jobs, jobids, profile):
+    '''
+    request_memory (MB) and MaxRuntime (s) of each job: from the profile of its sample if available
+    (20% margin on the peak memory, twice the expected runtime but at least 1h), otherwise the defaults.
+    '''
+    import math
+    resources = {}
+    for jobid in jobids:
+        job = jobs[int(jobid)]
+        prof = profile.get(job['samp'], {})
+        memory, runtime = args.request_memory, args.max_runtime or '0'
+        if prof.get('memory_mb'):
+            memory = str(int(math.ceil(prof['memory_mb'] * 1.2 / 100.) * 100))
+        expected = None
+        if prof.get('sec_per_event') and job.get('nevents'):
+            expected = prof['sec_per_event'] * job['nevents']
+        elif prof.get('sec_per_file') and 'firstEntry' not in job:
+            expected = prof['sec_per_file'] * len(job['inputfiles'])
+        if expected and args.max_runtime:
+            runtime = str(int(max(3600, 2 * expected)))
+        resources[jobid] = (memory, runtime)
+    return resources
+
+
+def create_jobdir(args, configs, configfiles, joboutputdir):
+    '''
+    Create the jobdir w/ the config files and the metadata, and the output dir.
+    Returns the metadata, or None if the jobdir already exists in batch mode.
+    '''
+    # create jobdir
+    if os.path.exists(args.jobdir):
+        if args.batch:
+            logging.warning('jobdir %s already exists! Will not submit new jobs!' % args.jobdir)
+            return None
+        ans = input('jobdir %s already exists, remove? [yn] ' % args.jobdir)
+        if ans.lower()[0] == 'y':
+            # keep what the previous production learned
+            update_job_profile(args)
+            shutil.rmtree(args.jobdir)
+        else:
+            sys.exit(1)
+    os.makedirs(args.jobdir)
+
+    # create outputdir
+    if os.path.exists(joboutputdir):
+        if not args.batch:
+            ans = input('outputdir %s already exists, continue? [yn] ' % joboutputdir)
+            if ans.lower()[0] == 'n':
+                sys.exit(1)
+    else:
+        os.makedirs(joboutputdir)
+
+    # create config file for the scripts
+    if configs is not None:
+        for cfgname, cfgpath in zip(configs, configfiles):
+            with open(cfgpath, 'w') as f:
+                json.dump(configs[cfgname], f, ensure_ascii=True, indent=2, sort_keys=True)
+            shutil.copy2(cfgpath, joboutputdir)
+
+    # create metadata file
+    md = create_metadata(args)
+    md['joboutputdir'] = joboutputdir
+    from PhysicsTools.NanoHRTTools.helpers.metadataHelper import MetadataStore
+    MetadataStore.create(metadata_file(args), md).close()
+    # store the full metadata to the outputdir as well
+    import gzip
+    with gzip.open(os.path.join(args.outputdir, os.path.splitext(args.metadata)[0] + '.json.gz'), 'w') as fout:
+        fout.write(json.dumps(md).encode('utf-8'))
+    return md
+
+
 def submit(args, configs):
     logging.info('Preparing jobs...\n  - modules: %s\n  - cut: %s\n  - outputdir: %s' % (str(args.imports), args.cut, args.outputdir))
 
     scriptfile = os.path.join(os.path.dirname(__file__), 'run_postproc_condor.sh')
     macrofile = os.path.join(os.path.dirname(__file__), 'processor.py')
-    metadatafile = os.path.join(args.jobdir, args.metadata)
+    metadatafile = metadata_file(args)
     joboutputdir = os.path.join(args.outputdir, 'pieces')
 
     # create config file for the scripts
@@ -389,58 +902,30 @@ def submit(args, configs):
             configfiles.append(cfgpath)
 
     if not args.resubmit:
-        # create jobdir
-        if os.path.exists(args.jobdir):
-            if args.batch:
-                logging.warning('jobdir %s already exists! Will not submit new jobs!' % args.jobdir)
-                return
-            ans = input('jobdir %s already exists, remove? [yn] ' % args.jobdir)
-            if ans.lower()[0] == 'y':
-                shutil.rmtree(args.jobdir)
-            else:
-                sys.exit(1)
-        os.makedirs(args.jobdir)
-
-        # create outputdir
-        if os.path.exists(joboutputdir):
-            if not args.batch:
-                ans = input('outputdir %s already exists, continue? [yn] ' % joboutputdir)
-                if ans.lower()[0] == 'n':
-                    sys.exit(1)
-        else:
-            os.makedirs(joboutputdir)
-
-        # create config file for the scripts
-        if configs is not None:
-            for cfgname, cfgpath in zip(configs, configfiles):
-                with open(cfgpath, 'w') as f:
-                    json.dump(configs[cfgname], f, ensure_ascii=True, indent=2, sort_keys=True)
-                shutil.copy2(cfgpath, joboutputdir)
-
-        # create metadata file
-        md = create_metadata(args)
-        md['joboutputdir'] = joboutputdir
-        with open(metadatafile, 'w') as f:
-            json.dump(md, f, ensure_ascii=True, indent=2, sort_keys=True)
-        # store the metadata file to the outputdir as well
-        import gzip
-        with gzip.open(os.path.join(args.outputdir, args.metadata+'.gz'), 'w') as fout:
-            fout.write(json.dumps(md).encode('utf-8'))
+        md = create_jobdir(args, configs, configfiles, joboutputdir)
+        if md is None:
+            return
 
         # create CMSSW tarball
         tar_cmssw(args.tarball_suffix, args.batch)
 
-        njobs = len(md['jobs'])
-        jobids = [str(jobid) for jobid in range(njobs)]
+        jobs = md['jobs']
+        jobids = [str(jobid) for jobid in range(len(jobs))]
         jobids_file = os.path.join(args.jobdir, 'submit.txt')
 
     else:
         # resubmit
+        update_job_profile(args)
         jobids = check_job_status(args)[1]['failed']
+        store = metadata_store(args)
+        jobs = store.jobs()
+        store.close()
         jobids_file = os.path.join(args.jobdir, 'resubmit.txt')
 
+    # per-job memory and runtime requests
+    resources = job_resources(args, jobs, jobids, load_job_profile(args))
     with open(jobids_file, 'w') as f:
-        f.write('\n'.join(jobids))
+        f.write('\n'.join('%s %s %s' % ((jobid,) + resources[jobid]) for jobid in jobids))
 
     # prepare the list of files to transfer
     files_to_transfer = [os.path.expandvars('$CMSSW_BASE/../CMSSW%s.tar.gz' % args.tarball_suffix), macrofile, metadatafile] + configfiles
@@ -467,10 +952,10 @@ Proxy_filename        = {proxyfile}
 Proxy_path            = {jobdir}/$(Proxy_filename)
 requirements          = (Arch == "X86_64") && (OpSys == "LINUX")
 MY.WantOS             = "{os_version}"
-request_memory        = {request_memory}
+request_memory        = $(JobMemory)
 request_disk          = 10000000
 executable            = {scriptfile}
-arguments             = $(jobid) $(Proxy_filename)
+arguments             = $(jobid) $(Proxy_filename) {metadata}
 transfer_input_files  = {files_to_transfer}
 output                = {jobdir}/$(jobid).out
 error                 = {jobdir}/$(jobid).err
@@ -488,54 +973,143 @@ on_exit_hold_reason   = strcat("Job held by ON_EXIT_HOLD due to ", ifThenElse((E
 {maxruntime}
 {condor_extras}
 
-queue jobid from {jobids_file}
+{queue}
 '''.format(scriptfile=os.path.abspath(scriptfile),
            files_to_transfer=','.join(files_to_transfer),
            jobdir=os.path.abspath(args.jobdir),
            # when outputdir is on EOS, disable file transfer as file is manually copied to EOS in processor.py
            initialdir=os.path.abspath(args.jobdir) if joboutputdir.startswith('/eos') else joboutputdir,
            transfer_output='transfer_output_files = ""' if joboutputdir.startswith('/eos') else '',
-           jobids_file=os.path.abspath(jobids_file),
+           # w/ `--dag`, the DAG sets jobid/JobMemory/JobRuntime of each node
+           queue='queue' if args.dag else 'queue jobid,JobMemory,JobRuntime from %s' % os.path.abspath(jobids_file),
            site='+DESIRED_Sites = "%s"' % args.site if args.site else '',
-           maxruntime='+MaxRuntime = %s' % args.max_runtime if args.max_runtime else '',
-           request_memory=args.request_memory,
+           maxruntime='+MaxRuntime = $(JobRuntime)' if args.max_runtime else '',
            condor_extras=args.condor_extras,
            proxyfile=proxyfile,
+           metadata=os.path.basename(metadatafile),
            os_version=os_version
     )
     condorfile = os.path.join(args.jobdir, 'submit.cmd')
     with open(condorfile, 'w') as f:
         f.write(condordesc)
 
-    cmd = 'condor_submit {condorfile}'.format(condorfile=condorfile)
+    if args.dag:
+        dagfile = os.path.join(args.jobdir, 'resubmit.dag' if args.resubmit else 'submit.dag')
+        write_dag(args, jobs, jobids, resources, condorfile, dagfile)
+        cmd = 'condor_submit_dag -f {dagfile}'.format(dagfile=dagfile)
+    else:
+        cmd = 'condor_submit {condorfile}'.format(condorfile=condorfile)
     print('Run the following command to submit the jobs:\n  %s' % cmd)
     if args.batch:
         import subprocess
         subprocess.Popen(cmd, shell=True).communicate()
 
 
-def run_add_weight(args):
-    if args.weight_file:
-        xsec_dict = parse_sample_xsec(args.weight_file)
-    import subprocess
-    md = load_metadata(args)
-    parts_dir = os.path.join(args.outputdir, 'parts')
-    status_file = os.path.join(parts_dir, '.success')    
+def write_dag(args, jobs, jobids, resources, condorfile, dagfile):
+    '''
+    Write the production as a DAG: one node per job, one hadd + weight node per sample that starts as soon as the jobs
+    of the sample are done, and one merge node per output of `--datasets` once all its samples are done.
+    The hadd + weight and merge nodes run `runPostProcessing.py --post-samples ...` in the local universe.
+    '''
+    def node_name(prefix, name):
+        return prefix + re.sub(r'[^\w\-]', '_', name)
+
+    dagdir = os.path.abspath(os.path.join(args.jobdir, 'dag'))
+    if not os.path.exists(dagdir):
+        os.makedirs(dagdir)
+    postfile = os.path.join(args.jobdir, 'post.cmd')
+    postdesc = '''\
+universe              = local
+getenv                = True
+executable            = {python}
+arguments             = "{script} -o {outputdir} -j {jobdir} -m {metadata} -d '{datasets}' -w '{weight_file}' --final-compression {final_compression} --nproc {nproc} --batch $(PostArgs)"
+initialdir            = {initialdir}
+output                = {dagdir}/$(NodeName).out
+error                 = {dagdir}/$(NodeName).err
+log                   = {dagdir}/post.log
+
+queue
+'''.format(python=sys.executable,
+           script=os.path.abspath(__file__),
+           outputdir=os.path.abspath(args.outputdir),
+           jobdir=os.path.abspath(args.jobdir),
+           metadata=args.metadata,
+           datasets=os.path.abspath(args.datasets) if args.datasets else '',
+           weight_file=os.path.abspath(args.weight_file) if args.weight_file else '',
+           final_compression=args.final_compression,
+           nproc=args.nproc,
+           initialdir=os.getcwd(),
+           dagdir=dagdir)
+    with open(postfile, 'w') as f:
+        f.write(postdesc)
+
+    lines = []
+    job_nodes = {}
+    for jobid in jobids:
+        name = 'job%s' % jobid
+        lines.append('JOB %s %s' % (name, os.path.abspath(condorfile)))
+        lines.append('VARS %s jobid="%s" JobMemory="%s" JobRuntime="%s"' % ((name, jobid) + resources[jobid]))
+        job_nodes.setdefault(jobs[int(jobid)]['samp'], []).append(name)
+
+    samples = []
+    for job in jobs:
+        if job['samp'] not in samples:
+            samples.append(job['samp'])
+    post_nodes = {}
+    for samp in samples:
+        name = node_name('post_', samp)
+        post_nodes[samp] = name
+        lines.append('JOB %s %s' % (name, os.path.abspath(postfile)))
+        lines.append('VARS %s NodeName="%s" PostArgs="--add-weight --post-samples %s"' % (name, name, samp))
+        if samp in job_nodes:
+            lines.append('PARENT %s CHILD %s' % (' '.join(job_nodes[samp]), name))
+
+    if args.datasets:
+        outtree_to_samples, _ = load_dataset_file(args.datasets)
+        for outtree_name in natural_sort(outtree_to_samples.keys()):
+            samps = [samp for samp in outtree_to_samples[outtree_name] if samp in post_nodes]
+            if not samps:
+                continue
+            name = node_name('merge_', outtree_name)
+            lines.append('JOB %s %s' % (name, os.path.abspath(postfile)))
+            lines.append('VARS %s NodeName="%s" PostArgs="--merge --post-samples %s"' % (name, name, ','.join(samps)))
+            lines.append('PARENT %s CHILD %s' % (' '.join(post_nodes[samp] for samp in samps), name))
+
+    with open(dagfile, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    logging.info('Written DAG %s w/ %d job, %d hadd + weight and %d merge nodes' % (
+        dagfile, len(jobids), len(post_nodes), sum(1 for l in lines if l.startswith('JOB merge_'))))
+    return dagfile
+
+
+def load_sample_sumw(args, jobs, samp):
+    '''Sums of weights of a sample from the sidecars of its jobs, or None if some of them are missing.'''
+    from PhysicsTools.NanoHRTTools.helpers.sumwHelper import read_sumw, merge_sumw
+    sidecars = [os.path.join(args.outputdir, 'pieces', '%s_%d_sumw.json' % (samp, job['idx']))
+                for job in jobs]
+    missing = [f for f in sidecars if not os.path.exists(f)]
+    if missing:
+        logging.debug('Missing %d sumw files for %s, will read the Runs tree instead' % (len(missing), samp))
+        return None
+    return merge_sumw([read_sumw(f) for f in sidecars])
+
+
+def _add_weight_sample(samp, args, xsec_dict, parts_dir):
+    '''hadd the pieces of one sample and add the xsec weight, returns the sample and the error (None if succeeded)'''
+    import traceback
+    status_file = os.path.join(parts_dir, '.%s.success' % samp)
     if os.path.exists(status_file):
-        return
-    if not os.path.exists(parts_dir):
-        os.makedirs(parts_dir)
-    for samp in md['samples']:
+        return samp, None
+    try:
         outfile = '{parts_dir}/{samp}_tree.root'.format(parts_dir=parts_dir, samp=samp)
-        cmd = 'haddnano.py {outfile} {outputdir}/pieces/{samp}_*_tree.root'.format(outfile=outfile, outputdir=args.outputdir, samp=samp)
-        logging.debug('...' + cmd)
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        log = p.communicate()[0]
-        log_lower = log.lower().decode('utf-8')
-        if 'error' in log_lower or 'fail' in log_lower:
-            logging.error(log)
-        if p.returncode != 0:
-            raise RuntimeError('Hadd failed on %s!' % samp)
+        from PhysicsTools.NanoHRTTools.helpers.mergeHelper import merge_files
+        store = metadata_store(args)
+        jobs = list(store.jobs(samp).values())
+        store.close()
+        infiles = [os.path.join(args.outputdir, 'pieces', '%s_%d_tree.root' % (samp, job['idx'])) for job in jobs]
+        # already running in a worker process of `run_add_weight`, so the groups are merged sequentially here
+        entries = merge_files(outfile, infiles)
+        logging.debug('Merged %d files into %s: %s' % (len(infiles), outfile, entries))
 
         # add weight
         if args.weight_file:
@@ -543,19 +1117,65 @@ def run_add_weight(args):
                 xsec = xsec_dict[samp]
                 if xsec is not None:
                     logging.info('Adding xsec weight to file %s, xsec=%f' % (outfile, xsec))
-                    add_weight_branch(outfile, xsec)
+                    add_weight_branch(outfile, xsec, sumw=load_sample_sumw(args, jobs, samp))
             except KeyError as e:
                 if '-' not in samp and '_' not in samp:
                     # data
                     logging.info('Not adding weight to sample %s' % samp)
                 else:
                     raise e
+    except Exception:
+        return samp, traceback.format_exc()
     with open(status_file, 'w'):
         pass
+    return samp, None
+
+
+def run_add_weight(args):
+    '''
+    hadd + add weight for the samples in parallel, `--nproc` at a time. Each sample gets its own success marker
+    (`parts/.<samp>.success`), so rerunning after a failure only processes the samples not done yet.
+    W/ `--post-samples`, only the listed samples are processed (one node of the DAG).
+    '''
+    import multiprocessing
+    import functools
+    xsec_dict = parse_sample_xsec(args.weight_file) if args.weight_file else None
+    store = metadata_store(args)
+    samples = store.samples()
+    store.close()
+    if args.post_samples:
+        selected = args.post_samples.split(',')
+        samples = [samp for samp in samples if samp in selected]
+    parts_dir = os.path.join(args.outputdir, 'parts')
+    status_file = os.path.join(parts_dir, '.success')
+    if os.path.exists(status_file):
+        return
+    if not os.path.exists(parts_dir):
+        os.makedirs(parts_dir)
+
+    # one sample per worker process: the ROOT state is not carried over between samples
+    pool = multiprocessing.Pool(min(args.nproc, len(samples)) or 1, maxtasksperchild=1)
+    failed = []
+    for samp, error in pool.imap_unordered(
+            functools.partial(_add_weight_sample, args=args, xsec_dict=xsec_dict, parts_dir=parts_dir), samples):
+        if error:
+            logging.error('Failed to add weight for %s:\n%s' % (samp, error))
+            failed.append(samp)
+        else:
+            logging.info('Done %s' % samp)
+    pool.close()
+    pool.join()
+    if failed:
+        raise RuntimeError('Add weight failed on %d samples: %s' % (len(failed), ','.join(failed)))
+    if not args.post_samples:
+        with open(status_file, 'w'):
+            pass
 
 
 def run_merge(args):
-    import subprocess
+    from PhysicsTools.NanoHRTTools.helpers.mergeHelper import merge_files, compression_setting
+    # the final outputs are recompressed w/ the high-ratio codec, the pieces/parts keep the fast one
+    compression = None if args.final_compression == 'keep' else compression_setting(args.final_compression)
 
     status_file = os.path.join(args.outputdir, '.success')
     if os.path.exists(status_file):
@@ -566,6 +1186,10 @@ def run_merge(args):
     merge_dict = {}  # outname: expected files
     merge_dict_found = {}  # outname: [infile list]
     outtree_to_samples, _ = load_dataset_file(args.datasets)
+    if args.post_samples:
+        # only the outputs containing the listed samples
+        selected = set(args.post_samples.split(','))
+        outtree_to_samples = {k: v for k, v in outtree_to_samples.items() if selected.intersection(v)}
 
     for outtree_name in outtree_to_samples:
         outname = '%s_tree.root' % outtree_name
@@ -584,34 +1208,219 @@ def run_merge(args):
         if len(merge_dict_found[outname]) != len(merge_dict[outname]):
             raise RuntimeError('Incomplete files for merging, missing: %s' % str(set(merge_dict[outname]) - set(merge_dict_found[outname])))
 
-        if len(merge_dict_found[outname]) == 1:
+        if len(merge_dict_found[outname]) == 1 and compression is None:
             os.rename(list(merge_dict_found[outname])[0], os.path.join(args.outputdir, outname))
         else:
-            cmd = 'haddnano.py {outfile} {infiles}'.format(outfile=os.path.join(args.outputdir, outname), infiles=' '.join(merge_dict_found[outname]))
-            logging.debug('...' + cmd)
-            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            log = p.communicate()[0]
-            if p.returncode != 0:
-                raise RuntimeError('Hadd failed on %s!' % outname)
-            log_lower = log.lower().decode('utf-8')
-            if 'error' in log_lower or 'fail' in log_lower:
-                logging.error(log)
+            outfile = os.path.join(args.outputdir, outname)
+            entries = merge_files(outfile, merge_dict_found[outname], nproc=args.nproc, compression=compression)
+            logging.debug('Merged %d files into %s: %s' % (len(merge_dict_found[outname]), outfile, entries))
 
-    with open(status_file, 'w'):
-        pass
+    if not args.post_samples:
+        with open(status_file, 'w'):
+            pass
 
 
-def run_all(args):
-    import multiprocessing
+def _run_local_job(jobid, args, workfiles, joboutputdir):
+    '''
+    Run one job in `jobdir/local/<jobid>` the same way the condor wrapper does. The log file gets the
+    condor-like "submitted" / "return value" lines, so `check_job_status` works for local jobs as well.
+    '''
+    import socket
+    import subprocess
+    jobdir = os.path.abspath(args.jobdir)
+    workdir = os.path.join(jobdir, 'local', str(jobid))
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    for f in workfiles:
+        os.symlink(f, os.path.join(workdir, os.path.basename(f)))
+
+    logpath = os.path.join(jobdir, '%d.log' % jobid)
+    with open(logpath, 'a') as logfile:
+        logfile.write('000 (%d) %s Job submitted from host: <%s>\n' % (jobid, time.strftime('%Y-%m-%d %H:%M:%S'), socket.getfqdn()))
+        logfile.write('001 (%d) %s Job executing on host: <%s>\n' % (jobid, time.strftime('%Y-%m-%d %H:%M:%S'), socket.getfqdn()))
+
+    env = dict(os.environ, MLAS_DYNAMIC_CPU_ARCH='99', TMPDIR=workdir)
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'processor.py'),
+           '-m', os.path.abspath(metadata_file(args)), str(jobid)]
+    with open(os.path.join(jobdir, '%d.out' % jobid), 'w') as fout, open(os.path.join(jobdir, '%d.err' % jobid), 'w') as ferr:
+        proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=fout, stderr=ferr)
+        # wait4 also gives the peak RSS of the job, for the job profile
+        _, status, rusage = os.wait4(proc.pid, 0)
+        returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    if returncode == 0:
+        # move the output to the output dir (processor.py has already staged it out if on EOS)
+        for f in os.listdir(workdir):
+            if (f.endswith('.root') or f.endswith('_sumw.json')) and not os.path.islink(os.path.join(workdir, f)):
+                shutil.move(os.path.join(workdir, f), os.path.join(joboutputdir, f))
+        shutil.rmtree(workdir)
+    with open(logpath, 'a') as logfile:
+        logfile.write('005 (%d) %s Job terminated.\n\t(1) Normal termination (return value %d)\n' % (
+            jobid, time.strftime('%Y-%m-%d %H:%M:%S'), returncode))
+        logfile.write('\t   Memory (MB)          :  %d  0  0\n' % (rusage.ru_maxrss // 1024))
+    return jobid, returncode
+
+
+def run_all(args, configs=None):
+    '''
+    Run the jobs locally, `--nproc` at a time. Each job is a separate `processor.py` process.
+    With `--resubmit`, only the jobs that have not completed (failed, or interrupted) are rerun.
+    '''
+    from multiprocessing.pool import ThreadPool
     import functools
-    pass
-#     md, njobs = update_metadata(args)
-#     pool = multiprocessing.Pool(args.nproc)
-#     pool.map(
-#         functools.partial(writeData, md, args.outputdir, batch_mode=False,
-#                           test_sample=args.test_sample, events=args.events_per_file, dryrun=args.dryrun),
-#         range(njobs)
-#         )
+    logging.info('Preparing jobs...\n  - modules: %s\n  - cut: %s\n  - outputdir: %s' % (str(args.imports), args.cut, args.outputdir))
+
+    joboutputdir = os.path.join(args.outputdir, 'pieces')
+    configfiles = [os.path.join(args.jobdir, cfgname) for cfgname in configs] if configs is not None else []
+
+    if not args.resubmit:
+        md = create_jobdir(args, configs, configfiles, joboutputdir)
+        if md is None:
+            return
+        jobs = md['jobs']
+        jobids = list(range(len(jobs)))
+    else:
+        store = metadata_store(args)
+        joboutputdir = store.option('joboutputdir')
+        jobs = store.jobs()
+        store.close()
+        # no local job is running at this point, so "running" ones were interrupted
+        status = check_job_status(args)[1]
+        jobids = sorted(int(j) for j in status['failed'] + status['running'])
+
+    if args.dryrun:
+        logging.info('Dry run, %d jobs not run.' % len(jobids))
+        return
+
+    # files looked up in the working directory of the job
+    workfiles = list(configfiles)
+    for f in (args.branchsel_in, args.branchsel_out):
+        if f:
+            workfiles.append(f)
+    if args.extra_transfer:
+        workfiles.extend(args.extra_transfer.split(','))
+    workfiles = [os.path.abspath(f) for f in workfiles]
+
+    run_job = functools.partial(_run_local_job, args=args, workfiles=workfiles, joboutputdir=joboutputdir)
+    if args.dag:
+        dagfile = os.path.join(args.jobdir, 'resubmit.dag' if args.resubmit else 'submit.dag')
+        resources = {str(jobid): (args.request_memory, args.max_runtime or '0') for jobid in jobids}
+        write_dag(args, jobs, [str(jobid) for jobid in jobids], resources, os.path.join(args.jobdir, 'submit.cmd'), dagfile)
+        run_dag(args, dagfile, run_job)
+        check_job_status(args)
+        return
+
+    logging.info('Running %d jobs w/ %d processes' % (len(jobids), args.nproc))
+    pool = ThreadPool(args.nproc)
+    for jobid, returncode in pool.imap_unordered(run_job, jobids):
+        if returncode == 0:
+            logging.info('Job %d (%s_%d) completed' % (jobid, jobs[jobid]['samp'], jobs[jobid]['idx']))
+        else:
+            logging.error('Job %d (%s_%d) failed with return value %d, see %s' % (
+                jobid, jobs[jobid]['samp'], jobs[jobid]['idx'], returncode,
+                os.path.join(args.jobdir, '%d.err' % jobid)))
+    pool.close()
+    pool.join()
+    check_job_status(args)
+
+
+def parse_dag(dagfile):
+    '''Nodes of a DAG file: {name: {'submit': submit file, 'vars': {...}, 'parents': set(...)}}, in file order.'''
+    import shlex
+    from collections import OrderedDict
+    nodes = OrderedDict()
+    with open(dagfile) as f:
+        for line in f:
+            tokens = shlex.split(line)
+            if not tokens or tokens[0].startswith('#'):
+                continue
+            if tokens[0] == 'JOB':
+                nodes[tokens[1]] = {'submit': tokens[2], 'vars': {}, 'parents': set()}
+            elif tokens[0] == 'VARS':
+                nodes[tokens[1]]['vars'].update(t.split('=', 1) for t in tokens[2:])
+            elif tokens[0] == 'PARENT':
+                sep = tokens.index('CHILD')
+                for child in tokens[sep + 1:]:
+                    nodes[child]['parents'].update(tokens[1:sep])
+    return nodes
+
+
+def _run_local_node(node):
+    '''Run the executable of the (local universe) submit file of a DAG node, w/ the VARS of the node.'''
+    import shlex
+    import subprocess
+    desc = {}
+    with open(node['submit']) as f:
+        for line in f:
+            if '=' in line:
+                key, value = line.split('=', 1)
+                desc[key.strip().lower()] = value.strip()
+
+    def expand(value):
+        return re.sub(r'\$\((\w+)\)', lambda m: node['vars'].get(m.group(1), ''), value)
+
+    cmd = [expand(desc['executable'])] + shlex.split(expand(desc.get('arguments', '')).strip('"'))
+    with open(expand(desc['output']), 'w') as fout, open(expand(desc['error']), 'w') as ferr:
+        return subprocess.call(cmd, cwd=desc.get('initialdir'), stdout=fout, stderr=ferr)
+
+
+def run_dag(args, dagfile, run_job):
+    '''
+    Run a DAG written by `write_dag` locally, `--nproc` nodes at a time: the job nodes w/ `run_job`, the other ones
+    w/ the command of their submit file. A node starts once all its parents succeeded, the descendants of a failed
+    node are skipped.
+    '''
+    from multiprocessing.pool import ThreadPool
+    import queue
+    nodes = parse_dag(dagfile)
+
+    def run_node(name):
+        try:
+            m = re.match(r'^job(\d+)$', name)
+            returncode = run_job(int(m.group(1)))[1] if m else _run_local_node(nodes[name])
+        except Exception:
+            logging.exception('Node %s failed' % name)
+            returncode = -1
+        return name, returncode
+
+    logging.info('Running DAG %s w/ %d nodes, %d at a time' % (dagfile, len(nodes), args.nproc))
+    pool = ThreadPool(args.nproc)
+    done = queue.Queue()
+    status = {}  # node -> return value, None if skipped
+    pending = list(nodes)
+    running = 0
+    while pending or running:
+        progressed = False
+        for name in list(pending):
+            parents = nodes[name]['parents']
+            if any(p in status and status[p] != 0 for p in parents):
+                pending.remove(name)
+                status[name] = None
+                progressed = True
+                logging.warning('Skipping node %s as some of its parents failed' % name)
+            elif all(status.get(p) == 0 for p in parents):
+                pending.remove(name)
+                running += 1
+                progressed = True
+                pool.apply_async(run_node, (name,), callback=done.put)
+        if running == 0:
+            if not progressed:
+                raise RuntimeError('Cannot schedule nodes %s of DAG %s, unknown parents?' % (','.join(pending), dagfile))
+            continue
+        name, returncode = done.get()
+        running -= 1
+        status[name] = returncode
+        if returncode == 0:
+            logging.info('Node %s completed' % name)
+        else:
+            logging.error('Node %s failed w/ return value %d' % (name, returncode))
+    pool.close()
+    pool.join()
+    failed = [name for name in nodes if status.get(name) != 0]
+    if failed:
+        logging.error('DAG %s: %d nodes failed or skipped: %s' % (dagfile, len(failed), ','.join(failed)))
+    return not failed
 
 
 def get_arg_parser():
@@ -624,8 +1433,8 @@ def get_arg_parser():
         help='Output directory'
     )
     parser.add_argument('-m', '--metadata',
-        default='metadata.json',
-        help='Metadata json file. Default: %(default)s'
+        default='metadata.db',
+        help='Metadata file (SQLite), a json file is converted on first use for jobdirs created w/ older versions. Default: %(default)s'
     )
     parser.add_argument('--extra-transfer',
         default=None,
@@ -641,7 +1450,7 @@ def get_arg_parser():
     )
     parser.add_argument('--resubmit',
         action='store_true', default=False,
-        help='Resubmit failed jobs. Default: %(default)s'
+        help='Resubmit failed jobs (w/ `-t interactive`: rerun all the jobs not completed). Default: %(default)s'
     )
     parser.add_argument('-j', '--jobdir',
         default='jobs',
@@ -659,14 +1468,38 @@ def get_arg_parser():
         default='',
         help='Ignored datasets, common separated regex. [Default: %(default)s]'
     )
-#     parser.add_argument('--nproc',
-#         type=int, default=8,
-#         help='Number of jobs to run in parallel. Default: %(default)s'
-#     )
+    parser.add_argument('--nproc',
+        type=int, default=8,
+        help='Number of jobs to run in parallel w/ `-t interactive`, and of samples to process in parallel w/ `--add-weight`. Default: %(default)s'
+    )
+    parser.add_argument('--das-client',
+        default='dasgoclient',
+        help='Command used to query DAS (called w/ `-query <query> -json`), or a json file w/ the dataset -> files mapping. Default: %(default)s'
+    )
+    parser.add_argument('--das-workers',
+        type=int, default=8,
+        help='Number of concurrent DAS queries. Default: %(default)s'
+    )
+    parser.add_argument('--das-cache-dir',
+        default='~/.cache/NanoHRTTools/das',
+        help='Directory to cache the file lists of the datasets. Default: %(default)s'
+    )
+    parser.add_argument('--das-cache-ttl',
+        type=float, default=24,
+        help='Time (in hours) the cached file lists stay valid, 0 to disable the cache. Default: %(default)s'
+    )
     parser.add_argument('-n', '--nfiles-per-job',
         type=int, default=10,
         help='Number of input files to process in one job. Default: %(default)s'
     )
+    parser.add_argument('--events-per-job',
+        type=int, default=0,
+        help='Target number of events per job, files above it are split into entry ranges. Overrides `--nfiles-per-job`. Default: %(default)s'
+    )
+    parser.add_argument('--size-per-job',
+        type=float, default=0,
+        help='Target input size per job, in MB, files above it are split into entry ranges. Overrides `--nfiles-per-job`. Default: %(default)s'
+    )
     parser.add_argument('--dryrun',
         action='store_true', default=False,
         help='Do not convert -- only produce metadata. Default: %(default)s'
@@ -687,6 +1520,15 @@ def get_arg_parser():
         default='2000',
         help='Request memory, in MB. Default: %(default)s'
     )
+    parser.add_argument('--job-profile',
+        default='',
+        help='Json file w/ the per-sample memory and runtime harvested from the logs of previous productions, used to set '
+             'the memory/runtime requests of each job. Updated on resubmission, `--add-weight`, and before removing a jobdir. Default: %(default)s'
+    )
+    parser.add_argument('--target-walltime',
+        type=float, default=0,
+        help='Target runtime per job, in hours: samples in `--job-profile` are re-split to fit it. Default: %(default)s'
+    )
     parser.add_argument('--add-weight',
         action='store_true', default=False,
         help='Merge output files of the same dataset and add cross section weight using the file specified in --weight-file. Default: %(default)s'
@@ -703,6 +1545,16 @@ def get_arg_parser():
         action='store_true', default=False,
         help='Add weight and merge. Default: %(default)s'
     )
+    parser.add_argument('--dag',
+        action='store_true', default=False,
+        help='Chain the jobs, hadd + weight of each sample and merge of each output in a DAG (`condor_submit_dag`, or run locally w/ `-t interactive`), '
+             'so the post-processing of a sample starts as soon as its jobs are done. Default: %(default)s'
+    )
+    parser.add_argument('--post-samples',
+        default='',
+        help='Comma separated list of samples: `--add-weight` only processes these samples, `--merge` only the outputs containing them. '
+             'Used by the DAG nodes. Default: %(default)s'
+    )
     parser.add_argument('--batch',
         action='store_true', default=False,
         help='Batch mode, do not ask for confirmation and submit the jobs directly. Default: %(default)s'
@@ -716,8 +1568,14 @@ def get_arg_parser():
     parser.add_argument("--bo", "--branch-selection-output", dest="branchsel_out", default='keep_and_drop_output.txt', help="Branch selection output")
     parser.add_argument("--friend", dest="friend", action="store_true", default=False, help="Produce friend trees in output (current default is to produce full trees)")
     parser.add_argument("-I", "--import", dest="imports", default=[], action="append", nargs=2, help="Import modules (python package, comma-separated list of ")
-    parser.add_argument("-z", "--compression", dest="compression", default=("LZ4:4"), help="Compression: none, or (algo):(level) ")
-    parser.add_argument("-P", "--prefetch", dest="prefetch", action="store_true", default=False, help="Prefetch input files locally instead of accessing them via xrootd")
+    parser.add_argument("-z", "--compression", dest="compression", default=("LZ4:4"), help="Compression of the job outputs, kept by the per-sample files of `--add-weight`: none, or (algo):(level). Default: %(default)s")
+    parser.add_argument("--final-compression", dest="final_compression", default="LZMA:9", help="Compression of the merged outputs of `--merge`: none, (algo):(level), or `keep` for the one of the job outputs. Default: %(default)s")
+    parser.add_argument("-P", "--prefetch", dest="prefetch", action="store_true", default=False, help="Kept for compatibility: remote input files are prefetched by default, see --no-prefetch")
+    parser.add_argument("--no-prefetch", dest="no_prefetch", action="store_true", default=False, help="Read remote input files via xrootd instead of copying them to the local scratch in the background")
+    parser.add_argument("--prefetch-eos", dest="prefetch_eos", action="store_true", default=False, help="Also copy EOS input files to the local scratch, instead of reading them via xrootd (set by the on-the-fly inference, which reads the inputs a second time w/ uproot)")
+    parser.add_argument("--prefetch-depth", dest="prefetch_depth", type=int, default=1, help="Number of input files copied ahead of the one being processed. Default: %(default)s")
+    parser.add_argument("--redirectors", dest="redirectors", default='', help="Comma separated list of xrootd redirectors probed at the start of each job for remote inputs, empty for the defaults of the host. Default: %(default)s")
+    parser.add_argument("--prefetch-budget", dest="prefetch_budget", type=float, default=8000, help="Max local disk space (MB) used by the prefetched files. Default: %(default)s")
     parser.add_argument("--long-term-cache", dest="longTermCache", action="store_true", default=False, help="Keep prefetched files across runs instead of deleting them at the end")
     parser.add_argument("-N", "--max-entries", dest="maxEntries", type=int, default=None, help="Maximum number of entries to process from any single given input tree")
     parser.add_argument("--first-entry", dest="firstEntry", type=int, default=0, help="First entry to process in the three (to be used together with --max-entries)")
@@ -734,11 +1592,19 @@ def run(args, configs=None):
         args.merge = True
 
     if args.add_weight:
-        all_completed, _ = check_job_status(args)
+        update_job_profile(args)
+        all_completed, jobids = check_job_status(args)
+        if args.post_samples:
+            # only the jobs of the selected samples need to be completed
+            store = metadata_store(args)
+            selected = set(str(jobid) for samp in args.post_samples.split(',') for jobid in store.jobs(samp))
+            store.close()
+            all_completed = selected.issubset(jobids['completed'])
         if not all_completed:
             if args.batch:
-                logging.warning('\033[1;30mThere are jobs failed or still running. Skipping...\033[0m')
-                return
+                # exit non-zero so that a DAG post node is retried instead of merging incomplete outputs
+                logging.error('\033[1;30mThere are jobs failed or still running. Skipping...\033[0m')
+                sys.exit(1)
             ans = input('Warning! There are jobs failed or still running. Continue adding weights? [yn] ')
             if ans.lower()[0] != 'y':
                 return
@@ -12,7 +12,8 @@ export X509_USER_PROXY=$2
 voms-proxy-info -all -file $2
    
 source /cvmfs/cms.cern.ch/cmsset_default.sh
-tar -xf CMSSW*.tar.gz --warning=no-timestamp
+# the tarball is made of concatenated tar.gz layers, `-i` reads past the end of each of them
+tar -xzif CMSSW*.tar.gz --warning=no-timestamp
 
 ### --------------------------------###
 #Keep track of release sandbox version
@@ -54,7 +55,7 @@ ls -l
 
 export MLAS_DYNAMIC_CPU_ARCH=99
 export TMPDIR=`pwd`
-python3 processor.py $jobid
+python3 processor.py -m ${3:-metadata.db} $jobid
 status=$?
 
 ls -l
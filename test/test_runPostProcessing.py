@@ -0,0 +1,66 @@
+import os
+import json
+import argparse
+import importlib.util
+import pytest
+
+metadataHelper = pytest.importorskip('PhysicsTools.NanoHRTTools.helpers.metadataHelper')
+
+_spec = importlib.util.spec_from_file_location(
+    'runPostProcessing', os.path.join(os.path.dirname(__file__), '..', 'run', 'runPostProcessing.py'))
+runPostProcessing = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(runPostProcessing)
+
+_md = {'outputdir': '/tmp/out', 'samples': ['s'], 'inputfiles': {'s': ['a.root', 'b.root']},
+       'jobs': [{'samp': 's', 'idx': 0, 'inputfiles': ['a.root']}, {'samp': 's', 'idx': 1, 'inputfiles': ['b.root']}]}
+
+
+def test_metadata_store(tmp_path):
+    metadataHelper.MetadataStore.create(str(tmp_path / 'metadata.db'), _md).close()
+    args = argparse.Namespace(jobdir=str(tmp_path), metadata='metadata.db')
+    store = runPostProcessing.metadata_store(args)
+    assert store.njobs() == 2
+    assert store.option('outputdir') == '/tmp/out'
+    store.close()
+
+
+def test_metadata_store_legacy_json(tmp_path):
+    # jobdirs created before the SQLite store only have the json, even w/ the default `-m metadata.db`
+    with open(str(tmp_path / 'metadata.json'), 'w') as f:
+        json.dump(_md, f)
+    args = argparse.Namespace(jobdir=str(tmp_path), metadata='metadata.db')
+    store = runPostProcessing.metadata_store(args)
+    assert store.jobs('s')[1]['inputfiles'] == ['b.root']
+    store.close()
+    assert os.path.exists(str(tmp_path / 'metadata.db'))
+
+
+def test_batch_post_incomplete_jobs(monkeypatch):
+    # a DAG post node must fail, not merge, while jobs are failed or still running
+    monkeypatch.setattr(runPostProcessing, 'update_job_profile', lambda args: None)
+    monkeypatch.setattr(runPostProcessing, 'check_job_status',
+                        lambda args: (False, {'running': [], 'failed': ['1'], 'completed': ['0']}))
+
+    def run_add_weight(args):
+        raise AssertionError('weights added w/ incomplete jobs')
+
+    monkeypatch.setattr(runPostProcessing, 'run_add_weight', run_add_weight)
+    args = argparse.Namespace(post=True, add_weight=False, merge=False, post_samples=None, batch=True)
+    with pytest.raises(SystemExit) as e:
+        runPostProcessing.run(args)
+    assert e.value.code == 1
+
+
+def test_tarball_layer_hash(tmp_path):
+    fname = str(tmp_path / 'a.txt')
+    with open(fname, 'w') as f:
+        f.write('a')
+    entries = [('CMSSW/a.txt', fname)]
+    h = runPostProcessing._tarball_layer_hash(entries)
+    # a rebuild that touches the file w/o changing it keeps the layer
+    os.utime(fname, (0, 0))
+    assert runPostProcessing._tarball_layer_hash(entries) == h
+    with open(fname, 'w') as f:
+        f.write('b')
+    os.utime(fname, (0, 0))
+    assert runPostProcessing._tarball_layer_hash(entries) != h
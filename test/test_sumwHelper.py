@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip('ROOT')
+
+from PhysicsTools.NanoHRTTools.helpers.sumwHelper import runs_sumw, merge_sumw
+
+
+class FakeRunsTree(object):
+    '''Stand-in for the `Runs` tree: one entry per element of `entries`, each a dict of branch values.'''
+
+    def __init__(self, entries, branches=('genEventSumw', 'LHEScaleSumw', 'LHEPdfSumw')):
+        self.entries = entries
+        self.branches = branches
+
+    def GetBranch(self, name):
+        return name in self.branches
+
+    def GetEntries(self):
+        return len(self.entries)
+
+    def GetEntry(self, i):
+        for k, v in self.entries[i].items():
+            setattr(self, k, v)
+
+
+def test_merge_with_empty_runs_tree():
+    # the job of a later entry range of a file keeps an empty Runs tree
+    full = runs_sumw(FakeRunsTree([{'genEventSumw': 2., 'LHEScaleSumw': [0.5, 1.], 'LHEPdfSumw': [1., 1., 2.]}]))
+    empty = runs_sumw(FakeRunsTree([]))
+    assert empty == {'genEventSumw': 0., 'LHEScaleSumw': None, 'LHEPdfSumw': None}
+    expected = {'genEventSumw': 2., 'LHEScaleSumw': [1., 2.], 'LHEPdfSumw': [2., 2., 4.]}
+    assert merge_sumw([full, empty]) == expected
+    assert merge_sumw([empty, full]) == expected
+
+
+def test_merge_inconsistent_lengths():
+    a = {'genEventSumw': 1., 'LHEScaleSumw': [1., 1.]}
+    b = {'genEventSumw': 1., 'LHEScaleSumw': [1.]}
+    with pytest.raises(RuntimeError):
+        merge_sumw([a, b])
@@ -0,0 +1,58 @@
+import pytest
+
+xrootdHelper = pytest.importorskip('PhysicsTools.NanoHRTTools.helpers.xrootdHelper')
+
+
+def test_prefetch_copy_raises(tmp_path):
+    files = ['root://host.example//store/a.root', 'root://host.example//store/b.root']
+    prefetcher = xrootdHelper.FilePrefetcher(files, workdir=str(tmp_path / 'prefetch'), verbose=False)
+
+    def copy(fname):
+        if fname.endswith('a.root'):
+            raise OSError('No space left on device')
+        localfile = str(tmp_path / 'prefetch' / 'b.root')
+        with open(localfile, 'w') as fout:
+            fout.write('b')
+        return localfile, 1, fname
+
+    prefetcher._copy = copy
+    # the file that failed is read remotely instead of blocking the iterator
+    assert list(prefetcher) == [files[0], str(tmp_path / 'prefetch' / 'b.root')]
+
+
+def make_check(bad_redirectors):
+    def check(url):
+        if any(url.startswith(r) for r in bad_redirectors):
+            raise IOError('Cannot open %s' % url)
+    return check
+
+
+def test_direct_read_failover():
+    selector = xrootdHelper.RedirectorSelector(['root://r1.example/', 'root://r2.example/'], verbose=False)
+    inputs = xrootdHelper.FailoverInputs(['root://r1.example//store/a.root', '/local/b.root'], selector,
+                                         check=make_check(['root://r1.example/']))
+    assert len(inputs) == 2
+    assert list(inputs) == ['root://r2.example//store/a.root', '/local/b.root']
+    assert selector.best == 'root://r2.example/'
+
+
+def test_direct_read_all_redirectors_fail():
+    selector = xrootdHelper.RedirectorSelector(['root://r1.example/', 'root://r2.example/', 'root://r3.example/'],
+                                               verbose=False)
+    check = make_check(['root://r1.example/', 'root://r2.example/', 'root://r3.example/'])
+    with pytest.raises(IOError):
+        xrootdHelper.open_with_failover('root://r1.example//store/a.root', selector, check=check)
+
+
+def test_prefetch_fallback_failover(tmp_path):
+    selector = xrootdHelper.RedirectorSelector(['root://r1.example/', 'root://r2.example/'], verbose=False)
+    files = ['root://r1.example//store/a.root']
+    prefetcher = xrootdHelper.FilePrefetcher(files, workdir=str(tmp_path / 'prefetch'), max_retry=0,
+                                             selector=selector, verbose=False, check=make_check(['root://r1.example/']))
+
+    def copy(fname):
+        raise OSError('No space left on device')
+
+    prefetcher._copy = copy
+    # the file that could not be copied is read remotely via the redirector that works
+    assert list(prefetcher) == ['root://r2.example//store/a.root']